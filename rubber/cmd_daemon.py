@@ -0,0 +1,281 @@
+# This file is part of Rubber and thus covered by the GPL
+"""
+This is the build daemon of Rubber and its client.
+
+The daemon listens on a UNIX socket and runs the command lines it receives as
+the command line interface would, in the client's directory and environment,
+sending back the output (its own and that of the programs it runs) and the
+exit code. Since it is a long-lived process, the interpreter and the program
+are only started once, the rules and modules are only loaded once, the digests
+of files are kept (see 'md5_file') and the indices of parsed sources are
+shared between builds, so that each build mostly pays for what actually
+changed. Each request still gets its own environment and parses its documents
+again (from the kept indices), since the modules keep the state of the
+document being built in their globals.
+"""
+
+import sys, os, stat
+import socket
+import cPickle
+import threading
+import traceback
+
+from rubber import _, msg
+from rubber import util
+import rubber.cmdline
+
+def default_socket ():
+	"""
+	Return the default path of the daemon's socket. It is in a directory
+	that belongs to the current user, in the runtime directory if there is
+	one, or in the temporary directory otherwise.
+	"""
+	dir = os.getenv("XDG_RUNTIME_DIR")
+	if not dir:
+		dir = os.getenv("TMPDIR", "/tmp")
+	return os.path.join(dir, "rubber-%d" % os.getuid(), "socket")
+
+def check_directory (dir):
+	"""
+	Make sure that the given directory exists and that only the current user
+	can access it, so that nobody else can talk to the daemon. Returns true
+	if this is the case.
+	"""
+	if not os.path.isdir(dir):
+		try:
+			os.makedirs(dir, 0700)
+		except OSError:
+			pass
+	try:
+		st = os.stat(dir)
+	except OSError:
+		return False
+	return st.st_uid == os.getuid() and stat.S_IMODE(st.st_mode) & 077 == 0
+
+class Channel (object):
+	"""
+	A file-like object that sends whatever is written to it through a
+	socket, as messages tagged with the given kind ("out" or "err"). The
+	channels of a request share a lock, since the relays write to them from
+	their own threads.
+	"""
+	def __init__ (self, file, kind, lock):
+		self.file = file
+		self.kind = kind
+		self.lock = lock
+
+	def write (self, text):
+		self.lock.acquire()
+		try:
+			cPickle.dump((self.kind, text), self.file, cPickle.HIGHEST_PROTOCOL)
+			self.file.flush()
+		finally:
+			self.lock.release()
+
+	def flush (self):
+		pass
+
+class Relay (object):
+	"""
+	This class redirects one of the file descriptors of the process (1 or
+	2) to a channel while a request is handled, so that the output of the
+	programs run for the request (LaTeX, BibTeX, converters...) reaches the
+	client instead of the daemon's terminal.
+	"""
+	def __init__ (self, fd, channel):
+		self.fd = fd
+		self.channel = channel
+		self.saved = os.dup(fd)
+		self.pipe, write = os.pipe()
+		os.dup2(write, fd)
+		os.close(write)
+		self.thread = threading.Thread(target=self.relay)
+		self.thread.setDaemon(True)
+		self.thread.start()
+
+	def relay (self):
+		"""
+		Copy what is written to the pipe into the channel, until the pipe is
+		closed. The pipe is drained even if the client is gone, so that the
+		programs writing to it do not block.
+		"""
+		while 1:
+			data = os.read(self.pipe, 4096)
+			if data == "":
+				break
+			try:
+				self.channel.write(data)
+			except socket.error:
+				pass
+		os.close(self.pipe)
+
+	def restore (self):
+		"""
+		Give the file descriptor back to the daemon and wait until everything
+		written to the pipe has been relayed.
+		"""
+		os.dup2(self.saved, self.fd)
+		os.close(self.saved)
+		self.thread.join()
+
+class Main (rubber.cmdline.Main):
+	"""
+	The command line interface as run by the daemon for each request. The
+	indices of parsed sources are shared by all the builds of the daemon.
+	"""
+	def __init__ (self, server):
+		rubber.cmdline.Main.__init__(self)
+		self.server = server
+
+	def parse_opts (self, cmdline, short="", long=[]):
+		args = rubber.cmdline.Main.parse_opts(self, cmdline, short, long)
+		self.daemon = 0
+		self.client = 0
+		return args
+
+	def new_environment (self):
+		env = rubber.cmdline.Main.new_environment(self)
+		env.depends.scans = self.server.scans
+		return env
+
+	def load_db (self, env, name):
+		rubber.cmdline.Main.load_db(self, env, name)
+		self.server.scans.update(env.depends.scans)
+		env.depends.scans = self.server.scans
+
+class Server (object):
+	"""
+	The build daemon. Requests are handled one at a time, each of them in the
+	client's directory and environment.
+	"""
+	def __init__ (self, path=None):
+		if path is None:
+			path = default_socket()
+		self.path = path
+		self.scans = {}
+		self.search_path = None
+
+	def serve (self):
+		"""
+		Listen on the socket and handle requests until interrupted. Returns
+		the exit code of the daemon.
+		"""
+		if not check_directory(os.path.dirname(self.path)):
+			msg.error(_("the directory of %s is not private") % self.path)
+			return 1
+		if os.path.exists(self.path):
+			os.unlink(self.path)
+		sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		sock.bind(self.path)
+		os.chmod(self.path, 0600)
+		sock.listen(5)
+		msg(1, _("listening on %s") % self.path)
+		try:
+			try:
+				while 1:
+					conn, addr = sock.accept()
+					try:
+						self.handle(conn)
+					finally:
+						conn.close()
+			except KeyboardInterrupt:
+				msg(0, _("*** interrupted"))
+		finally:
+			sock.close()
+			os.unlink(self.path)
+		return 0
+
+	def handle (self, conn):
+		"""
+		Handle one request: read the directory, environment and command line
+		of the client, run the command line and send back its output and
+		exit code.
+		"""
+		file = conn.makefile("rb+")
+		try:
+			cwd, environ, cmdline = cPickle.load(file)
+		except (EOFError, ValueError, cPickle.UnpicklingError):
+			return
+
+		saved = (os.getcwd(), os.environ.copy(), sys.stdout, sys.stderr,
+			msg.level, msg.short, msg.path, msg.cwd, msg.pos)
+		lock = threading.Lock()
+		sys.stdout.flush()
+		sys.stderr.flush()
+		relays = [Relay(1, Channel(file, "out", lock)),
+			Relay(2, Channel(file, "err", lock))]
+		try:
+			os.chdir(cwd)
+			os.environ.clear()
+			os.environ.update(environ)
+			util.directories.clear()
+			if environ.get("PATH") != self.search_path:
+				# The programs found may be different.
+				util.checked_progs.clear()
+				self.search_path = environ.get("PATH")
+			sys.stdout = Channel(file, "out", lock)
+			sys.stderr = Channel(file, "err", lock)
+			msg.level = 1
+			msg.short = 0
+			msg.path = ""
+			msg.pos = []
+			try:
+				ret = Main(self)(cmdline)
+			except SystemExit, e:
+				ret = e.code or 0
+			except socket.error:
+				return
+			except Exception:
+				sys.stderr.write(traceback.format_exc())
+				ret = 1
+		finally:
+			os.chdir(saved[0])
+			os.environ.clear()
+			os.environ.update(saved[1])
+			sys.stdout, sys.stderr = saved[2:4]
+			msg.level, msg.short, msg.path, msg.cwd, msg.pos = saved[4:]
+			for relay in relays:
+				relay.restore()
+
+		try:
+			cPickle.dump(("exit", ret), file, cPickle.HIGHEST_PROTOCOL)
+			file.flush()
+		except socket.error:
+			pass
+
+def forward (path, cmdline):
+	"""
+	Send a command line to the daemon listening on the given socket (or the
+	default one if 'path' is None) and relay its output. Returns the exit
+	code of the command, or None if no daemon can be reached.
+	"""
+	if path is None:
+		path = default_socket()
+	if not check_directory(os.path.dirname(path)):
+		return None
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		sock.connect(path)
+	except socket.error:
+		sock.close()
+		return None
+	file = sock.makefile("rb+")
+	try:
+		cPickle.dump((os.getcwd(), dict(os.environ), cmdline), file,
+			cPickle.HIGHEST_PROTOCOL)
+		file.flush()
+		while 1:
+			kind, data = cPickle.load(file)
+			if kind == "exit":
+				return data
+			elif kind == "out":
+				sys.stdout.write(data)
+				sys.stdout.flush()
+			else:
+				sys.stderr.write(data)
+	except (EOFError, socket.error):
+		msg.error(_("the connection to the build daemon was lost"))
+		return 1
+	finally:
+		file.close()
+		sock.close()
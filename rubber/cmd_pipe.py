@@ -52,12 +52,15 @@ class Main (rubber.cmdline.Main):
 This is Rubber version %s.
 usage: rubber-pipe [options]
 available options:
+      --abort              stop compiling at the first error
   -b, --bzip2              compress the final document with bzip2
   -c, --command=CMD        run the directive CMD before parsing (see man page)
+      --draftmode          use draft mode for intermediate compilations
   -e, --epilogue=CMD       run the directive CMD after parsing
   -z, --gzip               compress the final document
   -h, --help               display this help
       --into=DIR           go to directory DIR before compiling
+  -j, --jobs=NUM           run up to NUM conversions at the same time
   -k, --keep               keep the temporary files after compiling
   -l, --landscape          change paper orientation (if relevant)
   -n, --maxerr=NUM         display at most NUM errors (default: 10)
@@ -66,6 +69,8 @@ available options:
   -o, --post=MOD[:OPTS]    postprocess with module MOD (with options OPTS)
   -d, --pdf                produce a pdf (synonym for -m pdftex or -o ps2pdf)
   -p, --ps                 process through dvips (synonym for -m dvips)
+      --preamble-cache=DIR
+                           precompile the preamble into a format kept in DIR
   -q, --quiet              suppress messages
   -r, --read=FILE          read additional directives from FILE
   -S, --src-specials       enable insertion of source specials
@@ -120,6 +125,7 @@ available options:
 
 		env = Environment()
 		env.vars["cwd"] = initial_dir
+		env.depends.jobs = self.jobs
 
 		if env.set_source(src):
 			msg.error(_("cannot open the temporary %s") % src)
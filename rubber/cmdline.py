@@ -7,20 +7,33 @@ This is the command line interface for Rubber.
 import sys
 import os.path
 import string
+import time
+import tempfile
+import traceback
 from getopt import *
 
 from rubber import _, msg
+from rubber import util
 from rubber.environment import Environment
 from rubber.version import *
 from rubber.depend import ERROR, CHANGED, UNCHANGED
-from rubber.util import Variables, parse_line
+from rubber.util import Variables, parse_line, file_status
 
 class Main (object):
 	def __init__ (self):
 		self.max_errors = 10
+		self.jobs = 1
+		self.use_hash = 0
+		self.use_db = 0
 		self.include_only = None
 		self.path = []
 		self.compress = None
+		self.daemon = 0
+		self.client = 0
+		self.socket = None
+		self.watch = 0
+		self.watch_delay = 0.5
+		self.conversion_cache = None
 		msg.write = self.stderr_write
 
 	def stderr_write (self, text, level=0):
@@ -42,16 +55,25 @@ For more information, try `rubber --help'."""))
 This is Rubber version %s.
 usage: rubber [options] sources...
 available options:
+      --abort              stop compiling at the first error
   -b, --bzip2              compress the final document with bzip2
       --cache              use the (experimental) caching mechanism
       --clean              remove produced files instead of compiling
+      --client             send the command line to the build daemon
   -c, --command=CMD        run the directive CMD before parsing (see man page)
+      --conversion-cache=DIR
+                           keep the results of conversions in DIR
+      --daemon             run the build daemon
+      --db                 keep a database to skip parsing unchanged documents
+      --draftmode          use draft mode for intermediate compilations
   -e, --epilogue=CMD       run the directive CMD after parsing
   -f, --force              force at least one compilation
   -z, --gzip               compress the final document
   -h, --help               display this help
+      --hash               compare file contents instead of dates
       --inplace            compile the documents from their source directory
       --into=DIR           go to directory DIR before compiling
+  -j, --jobs=NUM           run up to NUM conversions or documents at once
       --jobname=NAME       set the job name for the first target
   -l, --landscape          change paper orientation (if relevant)
   -n, --maxerr=NUM         display at most NUM errors (default: 10)
@@ -60,26 +82,32 @@ available options:
   -o, --post=MOD[:OPTS]    postprocess with module MOD (with options OPTS)
   -d, --pdf                produce a pdf (synonym for -m pdftex or -o ps2pdf)
   -p, --ps                 process through dvips (synonym for -o dvips)
+      --preamble-cache=DIR
+                           precompile the preamble into a format kept in DIR
   -q, --quiet              suppress messages
   -r, --read=FILE          read additional directives from FILE
   -S, --src-specials       enable insertion of source specials
       --shell-escape       allows execution of arbitrary write18 commands
   -s, --short              display errors in a compact form
+      --socket=PATH        use PATH as the socket of the build daemon
   -I, --texpath=DIR        add DIR to the search path for LaTeX
   -v, --verbose            increase verbosity
       --version            print version information and exit
-  -W, --warn=TYPE          report warnings of the given TYPE (see man page)\
+  -W, --warn=TYPE          report warnings of the given TYPE (see man page)
+      --watch              rebuild the documents whenever their sources change\
 """) % version
 
 	def parse_opts (self, cmdline, short="", long=[]):
 		try:
 			opts, args = getopt(
-				cmdline, "I:bc:de:fhklm:n:o:pqr:SsvW:z" + short,
-				["bzip2", "cache", "clean", "command=", "epilogue=", "force", "gzip",
-				 "help", "inplace", "into=", "jobname=", "keep", "landcape", "maxerr=",
-				 "module=", "only=", "post=", "pdf", "ps", "quiet", "read=",
-				 "src-sepcials", "shell-escape", "short", "texpath=", "verbose", "version",
-				 "warn="] + long)
+				cmdline, "I:bc:de:fhj:klm:n:o:pqr:SsvW:z" + short,
+				["abort", "bzip2", "cache", "clean", "client", "command=",
+				 "conversion-cache=", "daemon", "db", "draftmode", "epilogue=",
+				 "force", "gzip", "hash", "help", "inplace", "into=", "jobs=",
+				 "jobname=", "keep", "landcape", "maxerr=", "module=", "only=",
+				 "post=", "pdf", "preamble-cache=", "ps", "quiet", "read=",
+				 "socket=", "src-sepcials", "shell-escape", "short", "texpath=",
+				 "verbose", "version", "warn=", "watch"] + long)
 		except GetoptError, e:
 			print e
 			sys.exit(1)
@@ -93,12 +121,24 @@ available options:
 					msg.warn(_("warning: ignoring option %s") % opt)
 				else:
 					self.compress = "bzip2"
+			elif opt == "--abort":
+				self.prologue.append("set abort yes")
 			elif opt == "--cache":
 				print 'warning: cache is currently disabled'
 			elif opt == "--clean":
 				self.clean = 1
+			elif opt == "--client":
+				self.client = 1
+			elif opt == "--daemon":
+				self.daemon = 1
+			elif opt == "--db":
+				self.use_db = 1
 			elif opt in ("-c", "--command"):
 				self.prologue.append(arg)
+			elif opt == "--conversion-cache":
+				self.conversion_cache = os.path.abspath(arg)
+			elif opt == "--draftmode":
+				self.prologue.append("set draftmode yes")
 			elif opt in ("-e", "--epilogue"):
 				self.epilogue.append(arg)
 			elif opt in ("-f", "--force"):
@@ -108,6 +148,8 @@ available options:
 					msg.warn(_("warning: ignoring option %s") % opt)
 				else:
 					self.compress = "gzip"
+			elif opt == "--hash":
+				self.use_hash = 1
 			elif opt in ("-h", "--help"):
 				self.help()
 				sys.exit(0)
@@ -115,6 +157,8 @@ available options:
 				self.place = None
 			elif opt == "--into":
 				self.place = arg
+			elif opt in ("-j", "--jobs"):
+				self.jobs = int(arg)
 			elif opt == "--jobname":
 				self.jobname = arg
 			elif opt in ("-k", "--keep"):
@@ -136,6 +180,8 @@ available options:
 					self.epilogue.append("module ps2pdf")
 				else:
 					self.prologue.append("module pdftex")
+			elif opt == "--preamble-cache":
+				self.prologue.append("set preamble-cache " + arg)
 			elif opt in ("-p", "--ps"):
 				self.epilogue.append("module dvips")
 				using_dvips = 1
@@ -147,6 +193,8 @@ available options:
 				self.prologue.append("set src-specials yes")
 			elif opt in ("--shell-escape"):
 				self.shell_escape = 1
+			elif opt == "--socket":
+				self.socket = arg
 			elif opt in ("-s", "--short"):
 				msg.short = 1
 			elif opt in ("-I", "--texpath"):
@@ -157,6 +205,8 @@ available options:
 				print "Rubber version: " + version
 				print "module path: " + moddir
 				sys.exit(0)
+			elif opt == "--watch":
+				self.watch = 1
 			elif opt in ("-W", "--warn"):
 				self.warn = 1
 				if arg == "all":
@@ -200,6 +250,16 @@ available options:
 
 		args = self.parse_opts(cmdline)
 
+		if self.daemon:
+			from rubber.cmd_daemon import Server
+			return Server(self.socket).serve()
+		if self.client and not self.watch:
+			from rubber.cmd_daemon import forward
+			ret = forward(self.socket, cmdline)
+			if ret is not None:
+				return ret
+			msg.log(_("no build daemon is running, building locally"))
+
 		initial_dir = os.getcwd()
 		msg.cwd = os.path.join(initial_dir, "")
 
@@ -209,108 +269,410 @@ available options:
 
 		msg.log(_("This is Rubber version %s.") % version)
 
+		if self.jobs > 1 and len(args) > 1 and not self.watch:
+			return self.build_parallel(args, initial_dir)
+
+		docs = []
 		for srcname in args:
-			src = os.path.abspath(os.path.join(initial_dir, srcname))
+			ret, doc = self.build_document(srcname, initial_dir)
+			if self.watch and doc is not None:
+				docs.append(doc)
+			elif ret:
+				return ret
+
+		if self.watch and docs != []:
+			return self.watch_documents(docs, initial_dir)
+		return 0
 
-			# Go to the appropriate directory
+	def build_document (self, srcname, initial_dir):
+		"""
+		Process (make or clean) a single document from the command line.
+		Returns a pair made of the exit code and a description of the
+		document that 'watch_documents' can use, or None if the document was
+		not parsed or was cleaned.
+		"""
+		src = os.path.abspath(os.path.join(initial_dir, srcname))
 
-			if self.place != ".":
-				if self.place is None:
-					msg.path = os.path.dirname(src)
-					os.chdir(os.path.dirname(src))
-					src = os.path.basename(src)
-				else:
-					os.chdir(self.place)
+		# Go to the appropriate directory
+
+		if self.place != ".":
+			if self.place is None:
+				msg.path = os.path.dirname(src)
+				os.chdir(os.path.dirname(src))
+				src = os.path.basename(src)
+			else:
+				os.chdir(self.place)
+
+		# Check the source and prepare it for processing
+
+		key = self.build_key()
+		env = self.load_document(src, self.jobname)
+		if env is None:
+			return 1, None
+
+		if self.clean:
+			if env.main.products == []:
+				msg.warn(_("there is no LaTeX source for %s") % srcname)
+				return 0, None
+		else:
+			if self.use_db and not self.force and not self.watch \
+					and env.check_state(key):
+				msg(1, _("nothing to be done for %s") % srcname)
+				self.jobname = None
+				if self.warn and self.display_warnings(env):
+					return 1, None
+				return 0, None
+			env.make_source()
+
+		doc = { "name": srcname, "source": src, "jobname": self.jobname,
+			"key": key, "env": env }
+		self.jobname = None
+
+		self.parse_document(env, initial_dir)
+
+		# Compile the document
 
-			# Check the source and prepare it for processing
-	
-			env = Environment()
+		if self.clean:
+			env.final.clean()
+			return 0, None
 
-			env.vars.new_key('shell_escape', self.shell_escape)
+		return self.make(env, srcname, key), doc
 
-			if env.set_source(src, jobname=self.jobname):
-				return 1
+	def build_parallel (self, args, initial_dir):
+		"""
+		Process the given documents in concurrent worker processes, at most
+		'jobs' at a time. Each document is processed by 'build_document' in
+		its own process, so that its working directory and its state are
+		private, and the conversions inside each document are done one at a
+		time. The messages of each document are displayed once it is done,
+		in the order of the command line, and the exit code is that of the
+		first document that failed in this order, so that the result does
+		not depend on timing. Unlike sequential processing, a failure does
+		not prevent the other documents from being processed.
+		"""
+		outputs = []
+		results = {}
+		running = {}
+		shown = 0
+		for index in range(len(args)):
+			while len(running) >= self.jobs:
+				self.wait_worker(running, results)
+			out = tempfile.TemporaryFile()
+			err = tempfile.TemporaryFile()
+			outputs.append((out, err))
+			sys.stdout.flush()
+			sys.stderr.flush()
+			pid = os.fork()
+			if pid == 0:
+				self.run_worker(args[index], initial_dir, out, err)
+			running[pid] = index
 			self.jobname = None
 
-			if self.include_only is not None:
-				env.main.includeonly(self.include_only)
+			while results.has_key(shown):
+				self.show_output(*outputs[shown])
+				shown += 1
 
-			if self.clean:
-				if env.main.products == []:
-					msg.warn(_("there is no LaTeX source for %s") % srcname)
-					continue
-			else:
-				env.make_source()
-
-			saved_vars = env.main.vars
-			env.main.vars = Variables(saved_vars, { "cwd": initial_dir })
-			for dir in self.path:
-				env.main.do_path(dir)
-			for cmd in self.prologue:
-				cmd = parse_line(cmd, env.main.vars)
-				env.main.command(cmd[0], cmd[1:], {'file': 'command line'})
-			env.main.vars = saved_vars
-
-			env.main.parse()
-
-			saved_vars = env.main.vars
-			env.main.vars = Variables(saved_vars, { "cwd": initial_dir })
-			for cmd in self.epilogue:
-				cmd = parse_line(cmd, env.main.vars)
-				env.main.command(cmd[0], cmd[1:], {'file': 'command line'})
-			env.main.vars = saved_vars
-
-			if self.compress is not None:
-				last_node = env.final
-				filename = last_node.products[0]
-				if self.compress == 'gzip':
-					from rubber.converters.gz import GzipDep
-					env.final = GzipDep(env.depends,
-							filename + '.gz', filename)
-				elif self.compress == 'bzip2':
-					from rubber.converters.bzip2 import Bzip2Dep
-					env.final = Bzip2Dep(env.depends,
-							filename + '.bz2', filename)
-
-			# Compile the document
-
-			if self.clean:
-				env.final.clean()
-				continue
+		while running != {}:
+			self.wait_worker(running, results)
+			while results.has_key(shown):
+				self.show_output(*outputs[shown])
+				shown += 1
 
-			if self.force:
-				ret = env.main.make(True)
-				if ret != ERROR and env.final is not env.main:
-					ret = env.final.make()
-				else:
-					# This is a hack for the call to get_errors() below
-					# to work when compiling failed when using -f.
-					env.final.failed_dep = env.main.failed_dep
+		for index in range(len(args)):
+			if results[index] != 0:
+				return results[index]
+		return 0
+
+	def run_worker (self, srcname, initial_dir, out, err):
+		"""
+		Process a document in a worker process created by 'build_parallel',
+		writing all the output into the given files, including that of the
+		programs it runs, and exit with the resulting code. This method
+		never returns.
+		"""
+		ret = 1
+		try:
+			try:
+				os.dup2(out.fileno(), 1)
+				os.dup2(err.fileno(), 2)
+				sys.stdout = out
+				sys.stderr = err
+				self.jobs = 1
+				ret = self.build_document(srcname, initial_dir)[0]
+			except KeyboardInterrupt:
+				ret = 2
+			except:
+				traceback.print_exc()
+		finally:
+			sys.stdout.flush()
+			sys.stderr.flush()
+			os._exit(ret)
+
+	def wait_worker (self, running, results):
+		"""
+		Wait for one of the worker processes in the dictionary 'running' to
+		terminate and record its exit code in 'results'.
+		"""
+		pid, status = os.waitpid(-1, 0)
+		index = running.pop(pid)
+		if os.WIFEXITED(status):
+			results[index] = os.WEXITSTATUS(status)
+		else:
+			results[index] = 1
+
+	def show_output (self, out, err):
+		"""
+		Display the output of a worker process, as stored in the given files,
+		and close the files.
+		"""
+		for file, dest in (out, sys.stdout), (err, sys.stderr):
+			file.seek(0)
+			while 1:
+				data = file.read(1 << 16)
+				if not data:
+					break
+				dest.write(data)
+			dest.flush()
+			file.close()
+
+	def load_document (self, src, jobname=None):
+		"""
+		Create the environment for building the given source, with the given
+		job name, and read its build database if requested. Returns the
+		environment, or None if the source cannot be used.
+		"""
+		env = self.new_environment()
+
+		env.vars.new_key('shell_escape', self.shell_escape)
+
+		if env.set_source(src, jobname=jobname):
+			return None
+
+		if self.include_only is not None:
+			env.main.includeonly(self.include_only)
+
+		if self.use_hash or self.use_db:
+			env.depends.use_hash = self.use_hash
+			self.load_db(env, env.main.target + ".rubber-db")
+		return env
+
+	def parse_document (self, env, initial_dir):
+		"""
+		Parse the sources of the document in the given environment, running
+		the directives of the command line before and after, and set the
+		final node of the environment accordingly.
+		"""
+		saved_vars = env.main.vars
+		env.main.vars = Variables(saved_vars, { "cwd": initial_dir })
+		for dir in self.path:
+			env.main.do_path(dir)
+		for cmd in self.prologue:
+			cmd = parse_line(cmd, env.main.vars)
+			env.main.command(cmd[0], cmd[1:], {'file': 'command line'})
+		env.main.vars = saved_vars
+
+		env.main.parse()
+
+		saved_vars = env.main.vars
+		env.main.vars = Variables(saved_vars, { "cwd": initial_dir })
+		for cmd in self.epilogue:
+			cmd = parse_line(cmd, env.main.vars)
+			env.main.command(cmd[0], cmd[1:], {'file': 'command line'})
+		env.main.vars = saved_vars
+
+		if self.compress is not None:
+			last_node = env.final
+			filename = last_node.products[0]
+			if self.compress == 'gzip':
+				from rubber.converters.gz import GzipDep
+				env.final = GzipDep(env.depends,
+						filename + '.gz', filename)
+			elif self.compress == 'bzip2':
+				from rubber.converters.bzip2 import Bzip2Dep
+				env.final = Bzip2Dep(env.depends,
+						filename + '.bz2', filename)
+
+	def make (self, env, srcname, key):
+		"""
+		Build the parsed document in the given environment and report the
+		errors or warnings. The argument 'key' describes the settings of the
+		build for the build database (see 'build_key'). Returns 0 on success
+		and 1 on failure.
+		"""
+		if self.force:
+			ret = env.main.make(True)
+			if ret != ERROR and env.final is not env.main:
+				ret = env.final.make()
 			else:
-				ret = env.final.make(self.force)
+				# This is a hack for the call to get_errors() below
+				# to work when compiling failed when using -f.
+				env.final.failed_dep = env.main.failed_dep
+		else:
+			ret = env.final.make(self.force)
 
+		if self.use_hash or self.use_db:
 			if ret == ERROR:
-				msg.info(_("There were errors compiling %s.") % srcname)
-				number = self.max_errors
-				for err in env.final.failed().get_errors():
-					if number == 0:
-						msg.info(_("More errors."))
-						break
-					msg.display(**err)
-					number -= 1
-				return 1
-
-			if ret == UNCHANGED:
-				msg(1, _("nothing to be done for %s") % srcname)
+				env.depends.graph = None
+			else:
+				env.save_state(key)
+			self.save_db(env, env.main.target + ".rubber-db")
+
+		if ret == ERROR:
+			msg.info(_("There were errors compiling %s.") % srcname)
+			number = self.max_errors
+			for err in env.final.failed().get_errors():
+				if number == 0:
+					msg.info(_("More errors."))
+					break
+				msg.display(**err)
+				number -= 1
+			return 1
+
+		if ret == UNCHANGED:
+			msg(1, _("nothing to be done for %s") % srcname)
+
+		if self.warn and self.display_warnings(env):
+			return 1
+		return 0
+
+	def watched_files (self, env):
+		"""
+		Return the files whose modification triggers a new build of the
+		document in the given environment, as a pair of lists: the sources,
+		i.e. the leaves of the dependency graph, and the files that the
+		compilation writes but that may also be changed from outside (the
+		files registered by the directives 'watch' and 'onchange').
+		"""
+		main = env.main
+		return (env.final.leaves(),
+			main.watched_files.keys() + main.onchange_md5.keys())
+
+	def watch_documents (self, docs, initial_dir):
+		"""
+		Watch the files of the given documents and rebuild the documents
+		whenever some of them change, until interrupted. The files are
+		polled, and a build only starts once they stopped changing for
+		'watch_delay' seconds, so that a burst of modifications (like saving
+		several files at once) causes a single build. Only the documents
+		that use the modified files are rebuilt, and only the nodes that
+		depend on the modified files are remade.
+		"""
+		status = {}
+		for doc in docs:
+			sources, outputs = self.watched_files(doc["env"])
+			for name in sources + outputs:
+				status[name] = file_status(name)
+
+		msg(0, _("watching for changes..."))
+		while 1:
+			time.sleep(self.watch_delay)
+			changed = {}
+			for name, old in status.items():
+				new = file_status(name)
+				if new != old:
+					changed[name] = new
+			if changed == {}:
+				continue
 
-			if self.warn:
-				log = env.main.log
-				if log.read(env.main.target + ".log"):
-					msg.error(_("cannot read the log file"))
-					return 1
-				msg.display_all(log.parse(boxes=self.warn_boxes,
-					refs=self.warn_refs, warnings=self.warn_misc))
+			# Wait for the modifications to settle.
+
+			while 1:
+				time.sleep(self.watch_delay)
+				settled = 1
+				for name in status.keys():
+					new = file_status(name)
+					if new != changed.get(name, status[name]):
+						changed[name] = new
+						settled = 0
+				if settled:
+					break
+			status.update(changed)
+
+			for doc in docs:
+				env = doc["env"]
+				sources, outputs = self.watched_files(env)
+				names = [name for name in sources + outputs
+					if changed.has_key(name)]
+				if names == []:
+					continue
+				msg(0, _("%s changed") % ", ".join(map(msg.simplify, names)))
+				os.chdir(env.vars["cwd"])
+				util.directories.clear()
+				env = self.update_document(doc, initial_dir)
+
+				# The outputs were rewritten by the build, while changes
+				# to the sources during the build must be noticed.
+				sources, outputs = self.watched_files(env)
+				for name in sources:
+					if not status.has_key(name):
+						status[name] = file_status(name)
+				for name in outputs:
+					status[name] = file_status(name)
+			os.chdir(initial_dir)
+
+	def update_document (self, doc, initial_dir):
+		"""
+		Rebuild a watched document after some of its files changed, and
+		return its new environment. The sources are always parsed again in
+		a new environment, even if none of them changed, because the modules
+		keep the state of the document being built in their globals and
+		another watched document may have been parsed since. The indices of
+		the sources are kept from the previous environment, so that only the
+		modified sources are actually read.
+		"""
+		env = doc["env"]
+		new = self.load_document(doc["source"], doc["jobname"])
+		if new is None:
+			return env
+		new.depends.scans = env.depends.scans
+		new.make_source()
+		self.parse_document(new, initial_dir)
+		doc["env"] = new
+
+		self.make(new, doc["name"], doc["key"])
+		return new
+
+	def new_environment (self):
+		"""
+		Return a new environment for building a document.
+		"""
+		env = Environment()
+		env.depends.jobs = self.jobs
+		env.depends.cache = self.conversion_cache
+		return env
 
+	def load_db (self, env, name):
+		"""
+		Read the build database from the given file into the dependency set
+		of the environment.
+		"""
+		env.depends.load(name)
+
+	def save_db (self, env, name):
+		"""
+		Write the dependency set of the environment into the given file.
+		"""
+		env.depends.save(name)
+
+	def build_key (self):
+		"""
+		Return a string that describes the settings that affect the building
+		of the current document, for use with the build database.
+		"""
+		return repr((version, self.jobname, self.include_only, self.path,
+			self.prologue, self.epilogue, self.compress, self.shell_escape))
+
+	def display_warnings (self, env):
+		"""
+		Display the warnings from the log file of the document, as requested
+		by the -W options. Returns 1 if the log file cannot be read.
+		"""
+		log = env.main.log
+		if log.read(env.main.target + ".log"):
+			msg.error(_("cannot read the log file"))
+			return 1
+		msg.display_all(log.parse(boxes=self.warn_boxes,
+			refs=self.warn_refs, warnings=self.warn_misc))
 		return 0
 
 	def __call__ (self, cmdline):
@@ -3,14 +3,84 @@ This module contains code for file conversion, including implicit conversion
 rule management.
 """
 
-import re, imp, os.path
+import re, sre_parse, sre_constants, imp, os.path
 from ConfigParser import *
 
-from rubber.util import _, msg, Variables
+from rubber.util import _, msg, Variables, file_status, file_exists
 import rubber.converters
 
 re_variable = re.compile('[a-zA-Z]+')
 
+# This matches the end of target expressions that only accept a fixed set of
+# extensions, like "(.*)\.(eps|pdf)" or "(.*)\.fig_t".
+re_suffixes = re.compile(
+	r'(^|[^\\])\\\.(\((?P<alts>\w+(\|\w+)*)\))?(?P<tail>\w*)$')
+
+# The rules and the converter modules do not depend on the document, so they
+# are only loaded once and shared by all converters: 'modules' associates the
+# name of each converter module with the module (or None if there is no such
+# module), and 'rule_files' associates the name of each rule file with the
+# status of the file when it was read and the rules it defines.
+
+modules = {}
+rule_files = {}
+
+def extension (name):
+	"""
+	Return the extension of the given file name, i.e. what follows the last
+	dot in its base name, or None if there is no such dot.
+	"""
+	i = name.rfind('.')
+	if i < 0 or name.find('/', i) >= 0:
+		return None
+	return name[i+1:]
+
+def target_extensions (expr):
+	"""
+	Return the list of the extensions of all the file names that the given
+	target expression can match (in the sense of 'extension'), or None if
+	this cannot be decided simply.
+	"""
+	m = re_suffixes.search(expr)
+	if not m or (m.group('alts') is None and m.group('tail') == ''):
+		return None
+	# Alternatives at top level would apply to part of the expression only.
+	depth = 0
+	escaped = False
+	for c in expr:
+		if escaped:
+			escaped = False
+		elif c == '\\':
+			escaped = True
+		elif c == '(':
+			depth += 1
+		elif c == ')':
+			depth -= 1
+		elif c == '|' and depth == 0:
+			return None
+	if m.group('alts') is None:
+		return [m.group('tail')]
+	return [alt + m.group('tail') for alt in m.group('alts').split('|')]
+
+def has_references (expr):
+	"""
+	Check if the given regular expression refers to its own groups, with
+	backreferences like \\1 or (?P=name) or with conditionals like
+	(?(1)...). Such references depend on the numbering of the groups, so the
+	expression cannot be joined with others into one alternation.
+	"""
+	todo = [sre_parse.parse(expr)]
+	while todo != []:
+		item = todo.pop()
+		if isinstance(item, sre_parse.SubPattern):
+			todo.extend(item.data)
+		elif isinstance(item, (tuple, list)):
+			if item[:1] in ((sre_constants.GROUPREF,),
+					(sre_constants.GROUPREF_EXISTS,)):
+				return True
+			todo.extend(item)
+	return False
+
 def expand_cases (string, vars):
 	"""
 	Expand variables and cases in a template string. Variables must occur as
@@ -87,12 +157,28 @@ class Rule (Variables):
 	"""
 	This class represents a single rule, as described in rules.ini. It is
 	essentially a dictionary, but also includes a compiled form of the regular
-	expression for the target.
+	expression for the target, the list of the extensions of the targets it
+	applies to (or None if it is not known) and the list of templates for the
+	source, with cases expanded and in parsed form (as used by the method
+	'expand' of match objects).
 	"""
 	def __init__ (self, context, dict):
 		Variables.__init__(self, context, dict)
 		self.cost = dict['cost']
 		self.re_target = re.compile(dict['target'] + '$')
+		self.extensions = target_extensions(dict['target'])
+		self.templates = []
+		if 'source' in dict:
+			for template in expand_cases(dict['source'], {})[0]:
+				self.templates.append(
+					sre_parse.parse_template(template, self.re_target))
+
+	def expand (self, match, template):
+		"""
+		Return the source name obtained from one of the templates, for a
+		target that matched the rule.
+		"""
+		return sre_parse.expand_template(template, match)
 
 class Converter (object):
 	"""
@@ -121,20 +207,37 @@ class Converter (object):
 		an empty set of rules.
 		"""
 		self.set = set
-		self.modules = {}
+		self.modules = modules
 		self.rules = {}
+		self.index = None
 
 	def read_ini (self, filename):
 		"""
 		Read a set of rules from a file. The file has the form of an INI file,
-		each section describes a rule.
+		each section describes a rule. The rules are shared with the other
+		converters that read the same file, it is only parsed again if it
+		changed.
 		"""
+		status = file_status(filename)
+		entry = rule_files.get(filename)
+		if entry is None or entry[0] != status:
+			entry = (status, self.parse_ini(filename))
+			rule_files[filename] = entry
+		self.rules.update(entry[1])
+		self.index = None
+
+	def parse_ini (self, filename):
+		"""
+		Parse a file of rules for 'read_ini' and return a dictionary that
+		associates the rules it contains with their names.
+		"""
+		rules = {}
 		cp = ConfigParser()
 		try:
 			cp.read(filename)
 		except ParsingError:
 			msg.error(_("parse error, ignoring this file"), file=filename)
-			return
+			return rules
 		for name in cp.sections():
 			dict = { 'name': name }
 			for key in cp.options(name):
@@ -159,12 +262,18 @@ class Converter (object):
 			if not self.load_module(dict['rule']):
 				msg.warn(_("ignoring rule `%s' (module `%s' not found)") %
 						(name, dict['rule']), file=filename)
-			self.rules[name] = Rule(None, dict)
+			try:
+				rules[name] = Rule(None, dict)
+			except re.error:
+				msg.warn(_("ignoring rule `%s' (invalid expression)") % name,
+						file=filename)
+		return rules
 
 	def load_module (self, name):
 		"""
-		Check if the module of the given name exists and load it. Returns True
-		if the module was loaded and False otherwise.
+		Check if the module of the given name exists and load it, unless
+		another converter already did. Returns True if the module was loaded
+		and False otherwise.
 		"""
 		if name in self.modules:
 			return self.modules[name] is not None
@@ -176,13 +285,68 @@ class Converter (object):
 		self.modules[name] = imp.load_module(name, *answer)
 		return True
 
+	def make_index (self):
+		"""
+		Build the index of the rules, used to find the rules that may apply
+		to a given target without trying all of them. The index is a tuple
+		(by_ext, others, re_all, apart), where 'by_ext' associates each
+		extension with the list of rules whose targets have this extension,
+		'others' is the list of the rules whose target extensions are not
+		known, 're_all' is a regular expression that matches all the targets
+		of all rules except those in the list 'apart' (or None if it cannot
+		be compiled). The rules whose targets refer to their own groups are
+		kept apart, since joining them would renumber the groups.
+		"""
+		by_ext = {}
+		others = []
+		joined = []
+		apart = []
+		for rule in self.rules.values():
+			if has_references(rule['target']):
+				apart.append(rule)
+			else:
+				joined.append(rule)
+			if rule.extensions is None:
+				others.append(rule)
+				continue
+			for ext in rule.extensions:
+				by_ext.setdefault(ext, []).append(rule)
+		try:
+			re_all = re.compile('|'.join(['(?:%s)$' % rule['target']
+				for rule in joined]))
+		except (re.error, AssertionError):
+			# This may happen if there are too many groups, or if two rules
+			# use the same group name.
+			re_all = None
+		self.index = (by_ext, others, re_all, apart)
+
+	def candidates (self, target):
+		"""
+		Return the list of the rules whose target expression may match the
+		given file name.
+		"""
+		if self.index is None:
+			self.make_index()
+		by_ext, others, re_all, apart = self.index
+		return by_ext.get(extension(target), []) + others
+
 	def may_produce (self, name):
 		"""
 		Return true if the given filename may be that of a file generated by
 		this converter, i.e. if it matches one of the target regular
 		expressions.
 		"""
-		for rule in self.rules.values():
+		if self.index is None:
+			self.make_index()
+		re_all, apart = self.index[2:]
+		if re_all is not None:
+			if re_all.match(name) is not None:
+				return True
+			for rule in apart:
+				if rule.re_target.match(name):
+					return True
+			return False
+		for rule in self.candidates(name):
 			if rule.re_target.match(name):
 				return True
 		return False
@@ -200,16 +364,15 @@ class Converter (object):
 		"""
 		candidates = []
 
-		for rule in self.rules.values():
+		for rule in self.candidates(target):
 			match = rule.re_target.match(target)
 			if not match:
 				continue
-			templates, _ = expand_cases(rule['source'], {})
-			for template in templates:
-				source = match.expand(template)
+			for template in rule.templates:
+				source = rule.expand(match, template)
 				if source == target:
 					continue
-				if not os.path.exists(source):
+				if not file_exists(source):
 					continue
 				candidates.append((rule['cost'], source, target, rule))
 
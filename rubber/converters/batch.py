@@ -0,0 +1,213 @@
+# This file is covered by the GPL as part of Rubber.
+"""
+Shell conversion rule for programs that can convert several files at once.
+
+The rule is used like the "shell" rule, with the following variables:
+- "command" is the command line for a single conversion, as for "shell",
+- "batch_head", "batch_item" and "batch_tail" describe a command line that
+  makes several conversions: it is made of the head, then of the item for
+  each conversion (with its own "source" and "target") and of the tail.
+
+Each target still has its own dependency node, but the nodes that use the
+same rule with the same head and tail form a batch: when one of them has to
+be made, the other ones that have to be made as well are made by the same
+process, so that many small conversions do not each pay for starting the
+program. When several jobs are allowed, the pending conversions are split
+among them. If a batched command fails, its conversions are done again one
+by one, so that each node gets its own result.
+"""
+
+import os, os.path
+import threading, time
+from subprocess import Popen
+
+from rubber import _, msg
+from rubber.util import parse_line, prog_available
+from rubber.depend import Shell
+
+# The maximum number of conversions made by a single process.
+batch_size = 64
+
+class Chunk (object):
+	"""
+	A group of nodes converted by a single command. The attribute 'results'
+	associates the nodes (by identity) with the result of their conversion,
+	and the event 'done' is set when they are known. The chunk is made by
+	the first of its nodes that runs, the other ones wait for it.
+	"""
+	def __init__ (self, nodes):
+		self.nodes = nodes
+		self.started = False
+		self.results = {}
+		self.done = threading.Event()
+		self.date = None
+
+class Batch (object):
+	"""
+	The set of the nodes that can be converted together. Nodes are assigned
+	to chunks when one of them runs, the other nodes of the chunk then just
+	wait for its result.
+	"""
+	def __init__ (self, set, head, tail):
+		self.set = set
+		self.head = head
+		self.tail = tail
+		self.members = []
+		self.chunks = {}
+		self.lock = threading.Lock()
+
+	def pending (self, node):
+		"""
+		Check if the given node is not made yet and needs to be, so that it
+		can be added to a chunk.
+		"""
+		if node.making or self.chunks.has_key(id(node)):
+			return False
+		for name in node.sources:
+			if not os.path.exists(name):
+				return False
+		entry = node.cache_entry()
+		if entry is not None and os.path.isdir(entry):
+			return False
+		return node.should_make()
+
+	def make_chunks (self, node):
+		"""
+		Split the given node and the other pending nodes into chunks, as many
+		as the number of jobs that may run at the same time, and return the
+		chunk of the given node. The nodes are dealt in turn to the chunks,
+		so that the nodes started together by the scheduler are in different
+		chunks and each of them runs its own chunk instead of waiting.
+		"""
+		nodes = [node] + \
+			[m for m in self.members if m is not node and self.pending(m)]
+		count = max(min(self.set.jobs, len(nodes)), 1)
+		count = max(count, (len(nodes) + batch_size - 1) / batch_size)
+		for i in range(count):
+			chunk = Chunk(nodes[i::count])
+			for m in chunk.nodes:
+				self.chunks[id(m)] = chunk
+		return self.chunks.pop(id(node))
+
+	def run (self, node):
+		"""
+		Make the given node, with the other nodes of its chunk. Returns true
+		on success and false on failure.
+		"""
+		self.lock.acquire()
+		try:
+			chunk = self.chunks.pop(id(node), None)
+			if chunk is not None and chunk.done.isSet() \
+					and not self.still_valid(chunk, node):
+				chunk = None
+			if chunk is None:
+				chunk = self.make_chunks(node)
+			owner = not chunk.started
+			chunk.started = True
+		finally:
+			self.lock.release()
+
+		if owner:
+			self.execute(chunk)
+		else:
+			chunk.done.wait()
+		return chunk.results[id(node)]
+
+	def still_valid (self, chunk, node):
+		"""
+		Check that the sources of a node did not change since the chunk it
+		was assigned to was made, in case the node was not made right after
+		(for instance because the build was interrupted).
+		"""
+		for name in node.sources:
+			if os.path.getmtime(name) > chunk.date:
+				return False
+		return True
+
+	def execute (self, chunk):
+		"""
+		Run the command for a chunk and record the results.
+		"""
+		chunk.date = time.time()
+		try:
+			if len(chunk.nodes) == 1:
+				node = chunk.nodes[0]
+				chunk.results[id(node)] = Shell.run(node)
+				return
+
+			command = self.head[:]
+			for node in chunk.nodes:
+				command.extend(node.item)
+			command.extend(self.tail)
+			before = {}
+			for node in chunk.nodes:
+				for name in node.products:
+					before[name] = product_date(name)
+			msg.progress(_("running: %s (%d conversions)") %
+				(command[0], len(chunk.nodes)))
+			msg.log(_("batch command: %s") % ' '.join(command))
+			if Popen(command).wait() == 0:
+				ok = lambda name: os.path.exists(name)
+			else:
+				# Keep the conversions that were made before the failure.
+				msg.info(_("the batched conversions failed, "
+					"making the remaining ones one by one"))
+				ok = lambda name: product_date(name) not in (None, before[name])
+
+			for node in chunk.nodes:
+				for name in node.products:
+					if not ok(name):
+						chunk.results[id(node)] = Shell.run(node)
+						break
+				else:
+					chunk.results[id(node)] = True
+		finally:
+			for node in chunk.nodes:
+				chunk.results.setdefault(id(node), False)
+			chunk.done.set()
+
+def product_date (name):
+	"""
+	Return the modification date of a file, or None if it does not exist.
+	"""
+	try:
+		return os.path.getmtime(name)
+	except OSError:
+		return None
+
+class Dep (Shell):
+	"""
+	The dependency node for a conversion made by a batch. The argument
+	'item' is the part of the batched command line for this conversion,
+	the argument 'command' is used when the conversion is done alone.
+	"""
+	def __init__ (self, set, command, item, batch, products, sources):
+		Shell.__init__(self, set, command, products, sources)
+		self.item = item
+		self.batch = batch
+		batch.members.append(self)
+
+	def run (self):
+		return self.batch.run(self)
+
+# The batches of the current dependency set, by rule and command shape. A
+# batch from another dependency set is replaced.
+
+batches = {}
+
+def check (source, target, context):
+	line = parse_line(context['batch_head'], context)
+	return prog_available(line[0])
+
+def convert (source, target, context, set):
+	head = parse_line(context['batch_head'], context)
+	tail = parse_line(context.get('batch_tail', ''), context)
+	key = (context['name'], tuple(head), tuple(tail))
+	batch = batches.get(key)
+	if batch is None or batch.set is not set:
+		batch = Batch(set, head, tail)
+		batches[key] = batch
+	return Dep(set,
+		parse_line(context['command'], context),
+		parse_line(context['batch_item'], context),
+		batch, [target], [source])
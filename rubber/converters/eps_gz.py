@@ -18,6 +18,9 @@ class Dep (Node):
 		self.source = source
 		self.target = target
 
+	def cache_key (self):
+		return "eps_gz"
+
 	def run (self):
 		"""
 		This method reads the source file (which is supposed to be a
@@ -8,8 +8,11 @@ building a LaTeX document from start to finish.
 """
 
 import os, os.path, sys, imp
-import re
+import re, mmap
+import multiprocessing, gc
 import string
+import hashlib
+from bisect import bisect_left
 
 from rubber import _
 from rubber.util import *
@@ -21,6 +24,39 @@ from rubber.tex import Parser, EOF, OPEN, SPACE, END_LINE
 
 #----  Module handler  ----{{{1
 
+# The modules found by 'find_module', by name. They are shared by all
+# documents, since the places they are searched for do not depend on the
+# document.
+
+known_modules = {}
+
+def find_module (name):
+	"""
+	Look for a module of the given name, first as a script in the 'modules'
+	directory in the program's data directory, then as a Python module in
+	the package `rubber.latex_modules'. Returns the path of the script, the
+	Python module, or None if the module was not found. The Python module is
+	loaded, and the result is remembered for the next calls.
+	"""
+	if known_modules.has_key(name):
+		return known_modules[name]
+	found = None
+	file = os.path.join(moddir, "modules", name + ".rub")
+	if os.path.exists(file):
+		found = file
+	else:
+		try:
+			file, path, descr = imp.find_module(name,
+					rubber.latex_modules.__path__)
+			try:
+				found = imp.load_module(name, file, path, descr)
+			finally:
+				file.close()
+		except ImportError:
+			pass
+	known_modules[name] = found
+	return found
+
 class Modules:
 	"""
 	This class gathers all operations related to the management of modules.
@@ -56,29 +92,27 @@ class Modules:
 			msg.debug(_("module %s already registered") % name, pkg='latex')
 			return 2
 
-		# First look for a script
+		# First look for a script in the current directory, then for a
+		# script or a Python module from the program
 
-		mod = None
-		for path in "", os.path.join(moddir, "modules"):
-			file = os.path.join(path, name + ".rub")
-			if os.path.exists(file):
-				mod = ScriptModule(self.env, file)
-				msg.log(_("script module %s registered") % name, pkg='latex')
-				break
-
-		# Then look for a Python module
+		if os.path.exists(name + ".rub"):
+			found = name + ".rub"
+		else:
+			found = find_module(name)
 
-		if not mod:
+		mod = None
+		if isinstance(found, basestring):
+			mod = ScriptModule(self.env, found)
+			msg.log(_("script module %s registered") % name, pkg='latex')
+		elif found is not None:
 			try:
-				file, path, descr = imp.find_module(name,
-						rubber.latex_modules.__path__)
-				pymodule = imp.load_module(name, file, path, descr)
-				file.close()
-				mod = PyModule(self.env, pymodule, dict)
+				mod = PyModule(self.env, found, dict)
 				msg.log(_("built-in module %s registered") % name, pkg='latex')
 			except ImportError:
-				msg.debug(_("no support found for %s") % name, pkg='latex')
-				return 0
+				pass
+		if not mod:
+			msg.debug(_("no support found for %s") % name, pkg='latex')
+			return 0
 
 		# Run any delayed commands.
 
@@ -116,7 +150,7 @@ class Modules:
 		else:
 			if not self.commands.has_key(mod):
 				self.commands[mod] = []
-			self.commands[mod].append((cmd, args, self.env.vars))
+			self.commands[mod].append((cmd, args, self.env.vars.snapshot()))
 
 
 #----  Log parser  ----{{{1
@@ -134,21 +168,59 @@ re_atline = re.compile(
 re_reference = re.compile("LaTeX Warning: Reference `(?P<ref>.*)' \
 on page (?P<page>[0-9]*) undefined on input line (?P<line>[0-9]*)\\.$")
 re_label = re.compile("LaTeX Warning: (?P<text>Label .*)$")
+re_citation = re.compile(
+"LaTeX Warning: Citation `(?P<cite>.*)' .*undefined.*")
 re_warning = re.compile(
 "(LaTeX|Package)( (?P<pkg>.*))? Warning: (?P<text>.*)$")
 re_online = re.compile("(; reported)? on input line (?P<line>[0-9]*)")
 re_ignored = re.compile("; all text was ignored after line (?P<line>[0-9]*).$")
 
+class MappedLines (object):
+	"""
+	The lines of a memory-mapped file, from a given offset. Iterating on an
+	instance produces the same strings as the method 'readlines' of files,
+	but one at a time, so that the lines are never all held in memory.
+	"""
+	def __init__ (self, buffer, start):
+		self.buffer = buffer
+		self.start = start
+
+	def __nonzero__ (self):
+		return self.start < len(self.buffer)
+
+	def __iter__ (self):
+		buffer = self.buffer
+		size = len(buffer)
+		pos = self.start
+		while pos < size:
+			end = buffer.find("\n", pos) + 1
+			if end == 0:
+				end = size
+			yield buffer[pos:end]
+			pos = end
+
 class LogCheck (object):
 	"""
 	This class performs all the extraction of information from the log file.
 	For efficiency, the instances contain the whole file as a list of strings
-	so that it can be read several times with no disk access.
+	so that it can be read several times with no disk access. Log files of
+	at least 'map_size' bytes are memory-mapped instead, and their lines are
+	produced on demand. The information is extracted in a single pass over
+	the lines, the first time it is requested, and kept in an index that all
+	queries use. The flags checked after each compilation (errors, rerun,
+	undefined citations) only need a quick scan of the raw lines, so they
+	are computed on their own when the messages are not needed.
 	"""
+	# The size from which log files are memory-mapped, None to never map.
+	map_size = 1 << 22
+
 	#-- Initialization {{{2
 
 	def __init__ (self):
 		self.lines = None
+		self.index = None
+		self.flags = None
+		self.map = None
 
 	def read (self, name):
 		"""
@@ -156,7 +228,7 @@ class LogCheck (object):
 		right compiler. Returns true if the log file is invalid or does not
 		exist.
 		"""
-		self.lines = None
+		self.close()
 		try:
 			file = open(name)
 		except IOError:
@@ -168,44 +240,165 @@ class LogCheck (object):
 		if not re_loghead.match(line):
 			file.close()
 			return 1
-		self.lines = file.readlines()
+		self.load(file)
+		return 0
+
+	def load (self, file):
+		"""
+		Store the lines of the given file, from the current position, and
+		close it. The file is memory-mapped if it is large enough.
+		"""
+		size = os.fstat(file.fileno()).st_size
+		if self.map_size is not None and size >= self.map_size:
+			self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+			self.lines = MappedLines(self.map, file.tell())
+		else:
+			self.lines = file.readlines()
 		file.close()
+
+	def close (self):
+		"""
+		Forget the contents of the log file, releasing its mapping if there
+		is one. This must be done before the file is overwritten, since a
+		mapping does not survive the truncation of the file.
+		"""
+		self.lines = None
+		self.index = None
+		self.flags = None
+		if self.map is not None:
+			self.map.close()
+			self.map = None
+
+	#-- Indexing {{{2
+
+	def get_index (self):
+		"""
+		Return the index of the log file, building it if necessary. The
+		index is a dictionary with the following entries:
+		- errors: true if there was an error during the compilation
+		- rerun: true if LaTeX indicated that another compilation is needed
+		- citations: the sorted list of undefined citations
+		- messages: the list of pairs (category, info) for all the
+		  information found by 'extract', in the order of the log file
+		"""
+		if self.index is None:
+			self.index = self.build_index(self.lines or [])
+		return self.index
+
+	def get_flags (self):
+		"""
+		Return a dictionary with the entries 'errors', 'rerun' and
+		'citations' of the index (see 'get_index'). If the index is not
+		built yet, they are computed from the raw lines only, without
+		extracting the messages.
+		"""
+		if self.index is not None:
+			return self.index
+		if self.flags is None:
+			flags = {}
+			for line in self.scan_flags(self.lines or [], flags):
+				pass
+			self.flags = flags
+		return self.flags
+
+	def build_index (self, lines):
+		"""
+		Build the index of the given lines of log, as described in
+		'get_index'. The lines are read only once: the checks that work on
+		raw lines are made while the lines are passed to 'extract'.
+		"""
+		index = {}
+		index["messages"] = list(self.extract(self.scan_flags(lines, index)))
+		return index
+
+	def scan_flags (self, lines, flags):
+		"""
+		Generate the given lines of log, setting the entries 'errors',
+		'rerun' and 'citations' of the dictionary 'flags' from them as they
+		are read. The entries are complete once all lines are generated.
+		"""
+		flags["errors"] = 0
+		flags["rerun"] = 0
+		citations = {}
+		self.skipping = 0
+		for line in lines:
+			if line[:14] == "LaTeX Warning:":
+				if re_rerun.match(line):
+					flags["rerun"] = 1
+				m = re_citation.match(line)
+				if m:
+					citations[m.group("cite")] = None
+			if self.is_error(line):
+				flags["errors"] = 1
+			yield line
+		flags["citations"] = citations.keys()
+		flags["citations"].sort()
+
+	def is_error (self, line):
+		"""
+		Check if a raw line of log is an error, given the lines previously
+		passed to this method since the attribute 'skipping' was reset.
+		Errors are lines that start with "!", except in bad box messages.
+		"""
+		if line.strip() == "":
+			self.skipping = 0
+		elif self.skipping:
+			pass
+		elif re_badbox.match(line):
+			self.skipping = 1
+		elif line[0] == "!":
+			# We check for the substring "pdfTeX warning" because pdfTeX
+			# sometimes issues warnings (like undefined references) in the
+			# form of errors...
+			return line.find("pdfTeX warning") == -1
 		return 0
 
+	#-- Live output {{{2
+
+	def start (self):
+		"""
+		Prepare for receiving the output of the compiler with 'watch'.
+		"""
+		self.close()
+		self.lines = []
+		self.skipping = 0
+		self.error = None
+
+	def watch (self, line):
+		"""
+		Store a line of the compiler's output, as it is produced. Returns
+		true once the first error has been read completely, in which case
+		the compilation can be stopped. The lines received so far can then
+		be analysed like the contents of a log file.
+		"""
+		self.lines.append(line)
+		if self.error is None:
+			if self.is_error(line):
+				self.error = 0
+			return 0
+		self.error += 1
+		return (re_line.match(line) is not None or line[:3] == "***"
+			or self.error >= 20)
+
 	#-- Process information {{{2
 
 	def errors (self):
 		"""
 		Returns true if there was an error during the compilation.
 		"""
-		skipping = 0
-		for line in self.lines:
-			if line.strip() == "":
-				skipping = 0
-				continue
-			if skipping:
-				continue
-			m = re_badbox.match(line)
-			if m:
-				skipping = 1
-				continue
-			if line[0] == "!":
-				# We check for the substring "pdfTeX warning" because pdfTeX
-				# sometimes issues warnings (like undefined references) in the
-				# form of errors...
-
-				if string.find(line, "pdfTeX warning") == -1:
-					return 1
-		return 0
+		return self.get_flags()["errors"]
 
 	def run_needed (self):
 		"""
 		Returns true if LaTeX indicated that another compilation is needed.
 		"""
-		for line in self.lines:
-			if re_rerun.match(line):
-				return 1
-		return 0
+		return self.get_flags()["rerun"]
+
+	def undefined_citations (self):
+		"""
+		Returns the sorted list of citations that LaTeX reported as undefined.
+		"""
+		return self.get_flags()["citations"][:]
 
 	#-- Information extraction {{{2
 
@@ -234,6 +427,23 @@ class LogCheck (object):
 		"""
 		if not self.lines:
 			return
+		wanted = {
+			"errors": errors,
+			"boxes": boxes,
+			"refs": refs,
+			"warnings": warnings
+			}
+		for category, info in self.get_index()["messages"]:
+			if wanted[category]:
+				yield info.copy()
+
+	def extract (self, lines):
+		"""
+		Extract all the relevant information from the given lines of log.
+		The function returns a generator of pairs (category, info) where
+		'category' is the name of the argument of 'parse' that selects the
+		item and 'info' is the dictionary described in 'parse'.
+		"""
 		last_file = None
 		pos = [last_file]
 		page = 1
@@ -244,7 +454,7 @@ class LogCheck (object):
 		accu = ""      # accumulated text from the previous line
 		macro = None   # the macro in which the error occurs
 		cseqs = {}     # undefined control sequences so far
-		for line in self.lines:
+		for line in lines:
 			line = line[:-1]  # remove the line feed
 
 			# TeX breaks messages at 79 characters, just to make parsing
@@ -287,14 +497,16 @@ class LogCheck (object):
 					parsing = 0
 					skipping = 1
 					pdfTeX = string.find(line, "pdfTeX warning") != -1
-					if error is not None and ((pdfTeX and warnings) or (errors and not pdfTeX)):
+					if error is not None:
 						if pdfTeX:
+							category = "warnings"
 							d = {
 								"kind": "warning",
 								"pkg": "pdfTeX",
 								"text": error[error.find(":")+2:]
 							}
 						else:
+							category = "errors"
 							d =	{
 								"kind": "error",
 								"text": error
@@ -313,28 +525,26 @@ class LogCheck (object):
 						if macro is not None:
 							d["macro"] = macro
 							macro = None
-						yield d
+						yield category, d
 				elif line[0] == "!":
 					error = line[2:]
 				elif line[0:3] == "***":
 					parsing = 0
 					skipping = 1
-					if errors:
-						yield	{
-							"kind": "abort",
-							"text": error,
-							"why" : line[4:],
-							"file": last_file
-							}
+					yield "errors", {
+						"kind": "abort",
+						"text": error,
+						"why" : line[4:],
+						"file": last_file
+						}
 				elif line[0:15] == "Type X to quit ":
 					parsing = 0
 					skipping = 0
-					if errors:
-						yield	{
-							"kind": "error",
-							"text": error,
-							"file": pos[-1]
-							}
+					yield "errors", {
+						"kind": "error",
+						"text": error,
+						"file": pos[-1]
+						}
 				continue
 
 			if len(line) > 0 and line[0] == "!":
@@ -358,11 +568,10 @@ class LogCheck (object):
 					if m:
 						info["line"] = m.group("line")
 						text = text[:m.start()] + text[m.end():]
-					if warnings:
-						info["text"] = text
-						d = { "kind": "warning" }
-						d.update( info )
-						yield d
+					info["text"] = text
+					d = { "kind": "warning" }
+					d.update( info )
+					yield "warnings", d
 					prefix = None
 				continue
 
@@ -370,25 +579,23 @@ class LogCheck (object):
 
 			m = re_reference.match(line)
 			if m:
-				if refs:
-					d =	{
-						"kind": "warning",
-						"text": _("Reference `%s' undefined.") % m.group("ref"),
-						"file": pos[-1]
-						}
-					d.update( m.groupdict() )
-					yield d
+				d =	{
+					"kind": "warning",
+					"text": _("Reference `%s' undefined.") % m.group("ref"),
+					"file": pos[-1]
+					}
+				d.update( m.groupdict() )
+				yield "refs", d
 				continue
 
 			m = re_label.match(line)
 			if m:
-				if refs:
-					d =	{
-						"kind": "warning",
-						"file": pos[-1]
-						}
-					d.update( m.groupdict() )
-					yield d
+				d =	{
+					"kind": "warning",
+					"file": pos[-1]
+					}
+				d.update( m.groupdict() )
+				yield "refs", d
 				continue
 
 			# Other warnings
@@ -412,20 +619,19 @@ class LogCheck (object):
 
 			m = re_badbox.match(line)
 			if m:
-				if boxes:
-					mpos = { "file": pos[-1], "page": page }
-					m = re_atline.search(line)
-					if m:
-						md = m.groupdict()
-						for key in "line", "last":
-							if md[key]: mpos[key] = md[key]
-						line = line[:m.start()]
-					d =	{
-						"kind": "warning",
-						"text": line
-						}
-					d.update( mpos )
-					yield d
+				mpos = { "file": pos[-1], "page": page }
+				m = re_atline.search(line)
+				if m:
+					md = m.groupdict()
+					for key in "line", "last":
+						if md[key]: mpos[key] = md[key]
+					line = line[:m.start()]
+				d =	{
+					"kind": "warning",
+					"text": line
+					}
+				d.update( mpos )
+				yield "boxes", d
 				skipping = 1
 				continue
 
@@ -451,14 +657,15 @@ class LogCheck (object):
 		first element, stack[0], contains the value None for errors that may
 		happen outside the source. Return the last file from which text was
 		read (the new stack top, or the one before the last closing
-		parenthesis).
+		parenthesis). Closing parentheses that do not match an opened file,
+		as found in some package messages, are ignored.
 		"""
 		m = re_file.search(line)
 		while m:
 			if line[m.start()] == '(':
 				last = m.group("file")
 				stack.append(last)
-			else:
+			elif len(stack) > 1:
 				last = stack[-1]
 				del stack[-1]
 			line = line[m.end():]
@@ -476,41 +683,318 @@ class LogCheck (object):
 			return before
 		return int(ms[-1]) + 1
 
+#----  Auxiliary files  ----{{{1
+
+re_aux_entry = re.compile(
+	r"\\(?P<kind>newlabel|bibcite|@writefile){(?P<name>[^{}]*)}(?P<value>.*)$")
+
+# Lines of auxiliary files that cannot change the output: they only concern
+# BibTeX or the reading of the file itself, or define helper macros.
+
+aux_ignored = ("%", "\\relax", "\\providecommand", "\\citation{",
+	"\\bibstyle{", "\\bibdata{", "\\@input{")
+
+def parse_aux (name):
+	"""
+	Read an auxiliary file and return a summary of what it contains that can
+	change the output, or None if the file does not exist. The summary is a
+	dictionary with the following entries:
+	- newlabel, bibcite: dictionaries of the values of labels and citations
+	- @writefile: a dictionary that maps each file extension to the list of
+	  entries written into that file (for tables of contents and such)
+	- other: the sorted list of all other relevant lines, for instance page
+	  counts or counter settings
+	"""
+	try:
+		file = open(name)
+	except IOError:
+		return None
+	aux = { "newlabel": {}, "bibcite": {}, "@writefile": {}, "other": [] }
+	for line in file:
+		line = line.strip()
+		if line == "" or line.startswith(aux_ignored):
+			continue
+		m = re_aux_entry.match(line)
+		if m is None:
+			aux["other"].append(line)
+		elif m.group("kind") == "@writefile":
+			aux["@writefile"].setdefault(m.group("name"), []).append(
+				m.group("value"))
+		else:
+			aux[m.group("kind")][m.group("name")] = m.group("value")
+	file.close()
+	aux["other"].sort()
+	return aux
+
+def aux_change (old, new):
+	"""
+	Compare two summaries of the same auxiliary file, as returned by
+	'parse_aux', and return the description of a difference that can change
+	the output, or None if there is no such difference.
+	"""
+	if old is None or new is None:
+		if old is new:
+			return None
+		return _("the file was created or removed")
+	for kind, what in ("newlabel", _("label")), ("bibcite", _("citation")):
+		for name, value in new[kind].items():
+			if not old[kind].has_key(name):
+				return _("the %s `%s' was added") % (what, name)
+			if old[kind][name] != value:
+				return _("the %s `%s' changed") % (what, name)
+		for name in old[kind].keys():
+			if not new[kind].has_key(name):
+				return _("the %s `%s' was removed") % (what, name)
+	files = old["@writefile"].keys() + new["@writefile"].keys()
+	for ext in files:
+		if old["@writefile"].get(ext) != new["@writefile"].get(ext):
+			return _("the entries for the %s file changed") % ext
+	if old["other"] != new["other"]:
+		return _("other definitions changed")
+	return None
+
+def md5_entries (name):
+	"""
+	Compute the MD5 sum of an auxiliary file, ignoring the lines that
+	'parse_aux' ignores and the white space at the end of lines.
+	"""
+	m = hashlib.md5()
+	file = open(name)
+	for line in file:
+		line = line.strip()
+		if line.endswith("%"):
+			line = line[:-1].rstrip()
+		if line != "" and not line.startswith(aux_ignored):
+			m.update(line + "\n")
+	file.close()
+	return m.digest()
+
+def md5_watched (name):
+	"""
+	Compute the MD5 sum of a watched file. Auxiliary files are summed with
+	'md5_entries', so that lines that cannot change the output are ignored,
+	other files (tables of contents and such) are summed byte for byte.
+	"""
+	if name[-4:] == ".aux":
+		return md5_entries(name)
+	return md5_file(name)
+
 #----  Parsing and compiling  ----{{{1
 
 re_command = re.compile("%[% ]*rubber: *(?P<cmd>[^ ]*) *(?P<arg>.*).*")
+re_scan = re.compile(r"\\(?:(?P<name>[a-zA-Z]+)[ \t]*|(?P<pair>[\\%])|.)|%.*|\n")
+
+def scan_source (text):
+	"""
+	Build the index of a LaTeX source, as used by 'LaTeXDep.parse_file'. The
+	index lists the control sequences found outside comments, together with
+	the directives in comment lines, so that the source can be processed for
+	any set of hooks without tokenizing it again. The return value is a pair
+	(lines, directives). The list 'lines' contains, for each line with
+	something relevant, a tuple (line, start, end, entries, directive) where
+	'line' is the line number, 'start' and 'end' are the offsets of the line
+	in the text, 'entries' is a list of tuples (column, name, stop) for the
+	control sequences in the line ('name' is None if it is not made of
+	letters, 'stop' is the column after the name and the following spaces)
+	and 'directive' is None or a pair (cmd, arg) for a directive line. The
+	list 'directives' contains the offsets of the directive lines.
+	"""
+	lines = []
+	directives = []
+	line = 1
+	start = 0
+	entries = []
+	for match in re_scan.finditer(text):
+		token = match.group()
+		if token == "\n":
+			if entries != []:
+				lines.append((line, start, match.end(), entries, None))
+				entries = []
+			line += 1
+			start = match.end()
+		elif token[0] == "%":
+			if entries == [] and text[start:match.start()].strip() == "":
+				command = re_command.match(token.strip())
+				if command is not None:
+					directives.append(start)
+					end = text.find("\n", match.end()) + 1
+					if end == 0:
+						end = len(text)
+					lines.append((line, start, end, None,
+						(command.group("cmd"), command.group("arg"))))
+		elif match.group("pair") is None:
+			entries.append((match.start() - start, match.group("name"),
+				match.end() - start))
+	if entries != []:
+		lines.append((line, start, len(text), entries, None))
+	return lines, directives
+
+# The inclusions that the pre-scan follows (see 'LaTeXDep.prescan').
+
+re_include = re.compile(
+	r"%.*|\\(?:input|include)(?![a-zA-Z])[ \t]*"
+	r"(?:\{(?P<arg>[^{}]*)\}|(?P<name>[^\s{}%\\]+))")
+
+def scan_file (path, digest):
+	"""
+	Index a source for the pre-scan. The return value is a pair (record,
+	names) where 'record' is the entry of the source in the indices of
+	parsed sources (see 'LaTeXDep.parse_file'), or None if the file could
+	not be read or if its digest is the given one, and 'names' is the list
+	of the names of the files it seems to include.
+	"""
+	try:
+		file = open(path)
+		try:
+			text = file.read()
+		finally:
+			file.close()
+	except IOError:
+		return None, []
+	names = []
+	for match in re_include.finditer(text):
+		name = match.group("arg") or match.group("name")
+		if name:
+			names.append(name.strip())
+	new = hashlib.md5(text).digest()
+	if new == digest:
+		return None, names
+	lines, directives = scan_source(text)
+	return (new, lines, directives, {}), names
+
+# The end of the sources used to dump a preamble into a format: it makes
+# \documentclass skip everything up to \begin{document}.
+
+format_trailer = r"""
+\makeatletter
+\def\documentclass{\rubber@skip}
+\long\def\rubber@skip#1\begin#2{\def\reserved@a{#2}%
+  \ifx\reserved@a\rubber@document
+    \expandafter\@firstoftwo
+  \else
+    \expandafter\@secondoftwo
+  \fi
+  {\begin{document}}\rubber@skip}
+\def\rubber@document{document}
+\makeatother
+\dump
+"""
 
 class SourceParser (Parser):
 	"""
 	Extends the general-purpose TeX parser to handle Rubber directives in the
 	comment lines.
+
+	The parser reads the text of a source from memory: the whole text is its
+	buffer, so that arguments that span several lines are read without going
+	through the input line by line. The offsets of the directive lines, as
+	found by 'scan_source', are given by the argument 'directives'. These
+	lines are executed when the parser reaches them, and they are not part of
+	the tokens read.
 	"""
-	def __init__ (self, file, dep):
-		Parser.__init__(self, file)
+	def __init__ (self, text, dep, directives=[]):
+		Parser.__init__(self, None)
 		self.latex_dep = dep
+		self.line = text
+		self.directives = directives
+		self.executed = 0
+		self.find_directive()
 
 	def read_line (self):
-		while Parser.read_line(self):
-			match = re_command.match(self.line.strip())
-			if match is None:
-				return True
+		return False
+
+	def find_directive (self):
+		"""
+		Set the attribute 'next_directive' to the offset of the first
+		directive line at or after the current position (or past the end of
+		the text if there is none).
+		"""
+		self.pending = bisect_left(self.directives, self.index)
+		if self.pending < len(self.directives):
+			self.next_directive = self.directives[self.pending]
+		else:
+			self.next_directive = len(self.line) + 1
 
-			vars = dict(self.latex_dep.vars.items())
-			vars['line'] = self.pos_line
-			args = parse_line(match.group("arg"), vars)
+	def skip_directive (self):
+		"""
+		Execute the directive line that starts at the current position, if
+		any, and move to the next line.
+		"""
+		start = self.next_directive
+		if self.index == start:
+			end = self.line.find("\n", start) + 1 or len(self.line)
+			match = re_command.match(self.line[start:end].strip())
+			self.directive(match.group("cmd"), match.group("arg"), self.pos_line)
+			self.executed += 1
+			if self.line[end-1:end] == "\n":
+				self.pos_line += 1
+			self.index = end
+		self.find_directive()
 
-			self.latex_dep.command(match.group("cmd"), args, vars)
-		return False
+	def read_token (self):
+		while self.index >= self.next_directive:
+			self.skip_directive()
+		return Parser.read_token(self)
+
+	def read_text (self, regexp):
+		"""
+		Read a run of text as 'Parser.read_text' does, stopping at the next
+		directive line.
+		"""
+		if self.next:
+			return ''
+		match = regexp.match(self.line, self.index, self.next_directive)
+		if match.end() == self.index:
+			return ''
+		self.index = match.end()
+		self.last_is_math = 0
+		text = match.group()
+		self.pos_line += text.count("\n")
+		return text
+
+	def directive (self, cmd, arg, line):
+		"""
+		Execute a directive found in a comment at the given line.
+		"""
+		vars = Variables(self.latex_dep.vars, { "line": line })
+		args = parse_line(arg, vars)
+		self.latex_dep.command(cmd, args, vars)
 
 	def skip_until (self, expr):
+		"""
+		Skip the input up to the first line, after the current one, that
+		starts with a match of the given regular expression, and move after
+		this match. Directives in the skipped lines are ignored.
+		"""
 		regexp = re.compile(expr)
-		while Parser.read_line(self):
-			match = regexp.match(self.line)
-			if match is None:
-				continue
-			self.line = self.line[match.end():]
-			self.pos_char += match.end()
-			return
+		text = self.line
+		pos = text.find("\n", self.index) + 1
+		while pos > 0:
+			self.pos_line += 1
+			match = regexp.match(text, pos)
+			if match is not None:
+				self.index = match.end()
+				break
+			pos = text.find("\n", pos) + 1
+		else:
+			self.index = len(text)
+		self.find_directive()
+
+	def offset (self):
+		"""
+		Return the offset of the current position in the text.
+		"""
+		return self.index
+
+	def jump (self, pos, line):
+		"""
+		Move to the offset 'pos' in the text, assuming that this position is
+		on the line number 'line'. Tokens that were put back are forgotten.
+		"""
+		self.index = pos
+		self.pos_line = line
+		self.next = []
+		self.find_directive()
 
 class EndDocument:
 	""" This is the exception raised when \\end{document} is found. """
@@ -555,6 +1039,9 @@ class LaTeXDep (Node):
 			"paper": "",
 			"arguments": [],
 			"src-specials": "",
+			"abort": "",
+			"draftmode": "",
+			"preamble-cache": "",
 			"source": None,
 			"target": None,
 			"path": None,
@@ -593,20 +1080,24 @@ class LaTeXDep (Node):
 			"endinput" : ("", self.h_endinput)
 		}
 		self.begin_hooks = {
+			"document": self.h_begin_document,
 			"verbatim": self.h_begin_verbatim,
 			"verbatim*": lambda loc: self.h_begin_verbatim(loc, env="verbatim\\*")
 		}
 		self.end_hooks = {
 			"document": self.h_end_document
 		}
-		self.hooks_changed = True
 
 		self.include_only = {}
+		self.preamble = None
+		self.preamble_sources = []
 
 		# description of the building process:
 
 		self.aux_md5 = {}
 		self.aux_old = {}
+		self.aux_data = {}
+		self.aux_data_old = {}
 		self.watched_files = {}
 		self.onchange_md5 = {}
 		self.onchange_cmd = {}
@@ -616,9 +1107,11 @@ class LaTeXDep (Node):
 		# state of the builder:
 
 		self.processed_sources = {}
+		self.compiled_digests = None
 
 		self.must_compile = 0
 		self.something_done = 0
+		self.draft_date = None
 		self.failed_module = None
 
 	def set_source (self, path, jobname=None):
@@ -710,6 +1203,10 @@ class LaTeXDep (Node):
 		"""
 		Parse the source for packages and supported macros.
 		"""
+		self.preamble = None
+		self.preamble_sources = []
+		if self.set.jobs > 1:
+			self.prescan()
 		try:
 			self.process(self.source())
 		except EndDocument:
@@ -717,32 +1214,128 @@ class LaTeXDep (Node):
 		self.set_date()
 		msg.log(_("dependencies: %r") % self.sources, pkg='latex')
 
+	def prescan (self):
+		"""
+		Index the main source and the sources it seems to include, directly
+		or not, in parallel using a pool of processes, so that 'parse_file'
+		finds their indices ready. The inclusions are found by a simple
+		search for \\input and \\include in the sources: this is only a
+		guess, the actual parsing, with the hooks run in document order,
+		still decides what is included, and sources missed by the pre-scan
+		are indexed when they are parsed.
+
+		The indices are made of many small tuples, the garbage collector is
+		disabled in the workers and while the indices are received, since
+		it would spend most of the time scanning them for nothing.
+		"""
+		def submit (path):
+			seen[path] = None
+			digest = self.set.scans.get(path, (None,))[0]
+			if pool is None:
+				return scan_file(path, digest)
+			return pool.apply_async(scan_file, (path, digest))
+
+		pool = None
+		seen = {}
+		collect = gc.isenabled()
+		gc.disable()
+		pending = [(self.source(), submit(self.source()))]
+		try:
+			while pending != []:
+				path, result = pending.pop(0)
+				if pool is not None:
+					result = result.get()
+				record, names = result
+				if record is not None:
+					self.set.scans[path] = record
+				for name in names:
+					if name.find("#") >= 0:
+						continue
+					file = self.env.find_file(name, ".tex")
+					if file is None or seen.has_key(file):
+						continue
+					if pool is None:
+						pool = multiprocessing.Pool(self.set.jobs, gc.disable)
+					pending.append((file, submit(file)))
+		finally:
+			if pool is not None:
+				pool.close()
+				pool.join()
+			if collect:
+				gc.enable()
+		msg.log(_("%d sources pre-scanned") % len(seen), pkg='latex')
+
 	def parse_file (self, file):
 		"""
 		Process a LaTeX source. The file must be open, it is read to the end
 		calling the handlers for the macro calls. This recursively processes
 		the included sources.
-		"""
-		parser = SourceParser(file, self)
-		parser.set_hooks(self.hooks.keys())
-		self.hooks_changed = False
-		while True:
-			if self.hooks_changed:
-				parser.set_hooks(self.hooks.keys())
-				self.hooks_changed = False
-			token = parser.next_hook()
-			if token.cat == EOF:
-				break
-			format, function = self.hooks[token.val]
-			args = []
-			for arg in format:
-				if arg == 'a':
-					args.append(parser.get_argument_text())
-				elif arg == 'o':
-					args.append(parser.get_latex_optional_text())
-			self.parser = parser
-			self.vars['line'] = parser.pos_line
-			function(self.vars, *args)
+
+		The source is not tokenized as a whole: its index of control
+		sequences and directives (see 'scan_source') is computed, or taken
+		from the cache of the dependency set if the contents of the file did
+		not change, and the parser, which reads the text from memory, is only
+		used to read the arguments of the hooks. Arguments read this way are
+		cached as well. As with 'Parser.next_hook', a control sequence is
+		only considered if it is the first one after the current position in
+		its line.
+		"""
+		text = file.read()
+		path = self.vars["file"]
+		digest = hashlib.md5(text).digest()
+		if self.set.scans.has_key(path) and self.set.scans[path][0] == digest:
+			msg.debug(_("using the index of %s") % path, pkg='latex')
+			digest, lines, directives, cache = self.set.scans[path]
+		else:
+			lines, directives = scan_source(text)
+			cache = {}
+			self.set.scans[path] = (digest, lines, directives, cache)
+
+		parser = SourceParser(text, self, directives)
+
+		for line, start, end, entries, directive in lines:
+			pos = parser.offset()
+			if directive is not None:
+				# Directives in lines that the parser did not reach are
+				# executed here, the other ones were already processed.
+				if start >= pos:
+					parser.directive(directive[0], directive[1], line)
+				continue
+			if end <= pos:
+				continue
+
+			for column, name, stop in entries:
+				if start + column < pos:
+					continue
+				if name is None or not self.hooks.has_key(name):
+					break
+				format, function = self.hooks[name]
+				key = (start + column, format)
+				if cache.has_key(key):
+					args, pos, pos_line = cache[key]
+					parser.jump(pos, pos_line)
+				else:
+					parser.jump(start + stop, line)
+					executed = parser.executed
+					args = []
+					for arg in format:
+						if arg == 'a':
+							args.append(parser.get_argument_text())
+						elif arg == 'o':
+							args.append(parser.get_latex_optional_text())
+
+					# The arguments can be reused if reading them did not
+					# execute any directive.
+
+					if parser.next == [] and parser.executed == executed:
+						cache[key] = (args, parser.offset(), parser.pos_line)
+
+				self.parser = parser
+				self.vars['line'] = parser.pos_line
+				function(self.vars, *args)
+				pos = parser.offset()
+				if pos >= end:
+					break
 
 	def process (self, path):
 		"""
@@ -838,7 +1431,6 @@ class LaTeXDep (Node):
 	def do_alias (self, name, val):
 		if self.hooks.has_key(val):
 			self.hooks[name] = self.hooks[val]
-			self.hooks_changed = True
 
 	def do_clean (self, *args):
 		for file in args:
@@ -933,7 +1525,6 @@ class LaTeXDep (Node):
 
 	def hook_macro (self, name, format, fun):
 		self.hooks[name] = (format, fun)
-		self.hooks_changed = True
 
 	def hook_begin (self, name, fun):
 		self.begin_hooks[name] = fun
@@ -1018,6 +1609,8 @@ class LaTeXDep (Node):
 				self.aux_md5[aux] = md5_file(aux)
 			else:
 				self.aux_md5[aux] = None
+			self.aux_data_old[aux] = None
+			self.aux_data[aux] = parse_aux(aux)
 
 	def h_includeonly (self, loc, files):
 		"""
@@ -1091,6 +1684,17 @@ class LaTeXDep (Node):
 		# The same remark as in 'h_bibliography' applies here.
 		self.hooks['bibliographystyle'][1](loc, name)
 
+	def h_begin_document (self, dict):
+		"""
+		Called when \\begin{document} is found. If this is in the main
+		source, the offset where the body starts and the sources read so far
+		are recorded so that the preamble can be precompiled (see
+		'preamble_format').
+		"""
+		if self.vars["file"] == self.source():
+			self.preamble = self.parser.offset()
+			self.preamble_sources = self.sources[:]
+
 	def h_begin_verbatim (self, dict, env="verbatim"):
 		"""
 		Called when \\begin{verbatim} is found. This disables all macro
@@ -1116,10 +1720,107 @@ class LaTeXDep (Node):
 
 	#--  Compilation steps  {{{2
 
-	def compile (self):
+	def preamble_format (self, env):
+		"""
+		Return a pair (dir, name) that designates a format file containing
+		the preamble of the main source, or None if the preamble is not
+		precompiled. Formats are stored in the directory given by the
+		variable 'preamble-cache' and named after a digest of the preamble,
+		of the files it reads (inputs, local classes and packages) and of
+		the compiler's settings, so that documents with the same preamble
+		share them. The format is dumped if it does not exist yet, with the
+		environment 'env'.
+		"""
+		if self.vars["preamble-cache"] == "" or self.preamble is None:
+			return None
+		if self.vars["engine"] == "VTeX":
+			msg.warn(_("I don't know how to precompile the preamble with %s.")
+				% self.vars["engine"])
+			self.preamble = None
+			return None
+
+		file = open(self.source())
+		text = file.read()
+		file.close()
+		end = text.rfind("\\begin", 0, self.preamble)
+		if end < 0:
+			self.preamble = None
+			return None
+		text = text[:end]
+
+		digest = hashlib.md5(repr((self.vars["program"],
+			self.vars["engine"], list(self.vars["arguments"]))))
+		digest.update(text)
+		inputs = self.preamble_sources[:]
+		for source in self.sources:
+			if source[-4:] in (".sty", ".cls") and source not in inputs:
+				inputs.append(source)
+		for source in inputs:
+			if source != self.source() and os.path.exists(source):
+				digest.update(md5_file(source))
+
+		dir = self.abspath(self.vars["preamble-cache"], self.source())
+		name = "rubber-" + digest.hexdigest()
+		if os.path.exists(os.path.join(dir, name + ".fmt")):
+			msg.log(_("using the format %s") % name, pkg='latex')
+			return dir, name
+		if not self.dump_format(text, dir, name, env):
+			self.preamble = None
+			return None
+		return dir, name
+
+	def dump_format (self, text, dir, name, env):
+		"""
+		Dump the given preamble as the format file 'name' in the directory
+		'dir'. The format redefines \\documentclass so that the preamble is
+		skipped when the source is compiled with it. Return true on success.
+		"""
+		msg.progress(_("precompiling the preamble of %s")
+			% msg.simplify(self.source()))
+		if not os.path.isdir(dir):
+			try:
+				os.makedirs(dir)
+			except OSError:
+				pass
+
+		# The format is dumped under a temporary job name and renamed, so
+		# that concurrent builds never see an incomplete format.
+
+		job = "%s-%d" % (name, os.getpid())
+		source = os.path.join(dir, job + ".ltx")
+		try:
+			file = open(source, "w")
+			file.write(text)
+			file.write(format_trailer)
+			file.close()
+		except IOError:
+			msg.warn(_("cannot write the preamble into %s") % dir)
+			return False
+
+		program = self.vars["program"]
+		cmd = [program, "-ini", "-interaction=nonstopmode",
+			"-jobname=" + job, "-output-directory=" + dir,
+			"&" + os.path.basename(program)]
+		cmd += self.vars["arguments"]
+		cmd.append(source)
+		self.env.execute(cmd, env, kpse=1)
+
+		format = os.path.join(dir, job + ".fmt")
+		if not os.path.exists(format):
+			msg.warn(_("the preamble of %s could not be precompiled, see %s")
+				% (msg.simplify(self.source()), os.path.join(dir, job + ".log")))
+			return False
+		os.rename(format, os.path.join(dir, name + ".fmt"))
+		for suffix in ".ltx", ".log":
+			if os.path.exists(os.path.join(dir, job + suffix)):
+				os.unlink(os.path.join(dir, job + suffix))
+		return True
+
+	def compile (self, draft=False):
 		"""
 		Run one LaTeX compilation on the source. Return true on success or
-		false if errors occured.
+		false if errors occured. If the optional argument is true, the
+		compiler runs in draft mode and the output file is not produced.
 		"""
 		msg.progress(_("compiling %s") % msg.simplify(self.source()))
 
@@ -1131,8 +1832,39 @@ class LaTeXDep (Node):
 		if file.find(" ") >= 0:
 			file = '"%s"' % file
 
+		# Remove the CWD from elements inthe path, to avoid potential problems
+		# with special characters if there are any (except that ':' in paths
+		# is not handled).
+
+		prefix = self.env.vars["cwd"]
+		prefix_ = os.path.join(prefix, "")
+		paths = []
+		for p in self.env.path:
+			if p == prefix:
+				paths.append(".")
+			elif p[:len(prefix_)] == prefix_:
+				paths.append("." + p[len(prefix):])
+			else:
+				paths.append(p)
+		inputs = string.join(paths, ":")
+
+		if inputs == "":
+			env = {}
+		else:
+			inputs = inputs + ":" + os.getenv("TEXINPUTS", "")
+			env = {"TEXINPUTS": inputs}
+
 		cmd = [self.vars["program"]]
 
+		format = self.preamble_format(env)
+		if format is not None:
+			dir, name = format
+			cmd.append("-fmt=" + name)
+			env["TEXFORMATS"] = dir + ":" + os.getenv("TEXFORMATS", "")
+
+		if draft:
+			cmd.append("-draftmode")
+
 		if self.set_job:
 			if self.vars["engine"] == "VTeX":
 				msg.error(_("I don't know how set the job name with %s.")
@@ -1155,43 +1887,41 @@ class LaTeXDep (Node):
 
 		cmd += [x.replace("%s",file) for x in self.cmdline]
 
-		# Remove the CWD from elements inthe path, to avoid potential problems
-		# with special characters if there are any (except that ':' in paths
-		# is not handled).
-
-		prefix = self.env.vars["cwd"]
-		prefix_ = os.path.join(prefix, "")
-		paths = []
-		for p in self.env.path:
-			if p == prefix:
-				paths.append(".")
-			elif p[:len(prefix_)] == prefix_:
-				paths.append("." + p[len(prefix):])
-			else:
-				paths.append(p)
-		inputs = string.join(paths, ":")
-
-		if inputs == "":
-			env = {}
+		if self.set.use_hash:
+			self.compiled_digests = self.source_digests()
+		if draft:
+			self.draft_date = time.time()
 		else:
-			inputs = inputs + ":" + os.getenv("TEXINPUTS", "")
-			env = {"TEXINPUTS": inputs}
-
-		self.env.execute(cmd, env, kpse=1)
-		self.something_done = 1
+			self.draft_date = None
+		if self.vars["abort"] == "yes":
+			self.log.start()
+			self.env.execute(cmd, env, kpse=1, out=self.log.watch)
+			self.something_done = 1
+			if self.log.errors():
+				# The output of an interrupted compilation is not usable.
+				if os.path.exists(self.products[0]):
+					os.unlink(self.products[0])
+				return False
+		else:
+			self.log.close()
+			self.env.execute(cmd, env, kpse=1)
+			self.something_done = 1
 
 		if self.log.read(self.target + ".log"):
 			msg.error(_("Could not run %s.") % cmd[0])
 			return False
 		if self.log.errors():
 			return False
-		if not os.access(self.products[0], os.F_OK):
+		if not draft and not os.access(self.products[0], os.F_OK):
 			msg.error(_("Output file `%s' was not produced.") %
 				msg.simplify(self.products[0]))
 			return False
 		for aux, md5 in self.aux_md5.items():
 			self.aux_old[aux] = md5
 			self.aux_md5[aux] = md5_file(aux)
+			self.aux_data_old[aux] = self.aux_data.get(aux)
+			if self.aux_md5[aux] != md5:
+				self.aux_data[aux] = parse_aux(aux)
 		return True
 
 	def pre_compile (self, force):
@@ -1208,6 +1938,8 @@ class LaTeXDep (Node):
 		else:
 			self.aux_md5[aux] = None
 		self.aux_old[aux] = None
+		self.aux_data_old[aux] = None
+		self.aux_data[aux] = parse_aux(aux)
 
 		self.log.read(self.target + ".log")
 
@@ -1249,7 +1981,8 @@ class LaTeXDep (Node):
 		"""
 		Remove all files that are produced by compilation.
 		"""
-		self.remove_suffixes([".log", ".aux", ".toc", ".lof", ".lot"])
+		self.remove_suffixes([".log", ".aux", ".toc", ".lof", ".lot",
+			".rubber-db"])
 
 		for file in self.products + self.removed_files:
 			if os.path.exists(file):
@@ -1286,13 +2019,23 @@ class LaTeXDep (Node):
 		self.failed_module = None
 
 		if force or self.compile_needed():
+			draft = self.draft_predicted(True)
 			self.must_compile = False
-			if not self.compile():
+			if not self.compile(draft):
 				return False
 			if not self.post_compile():
 				return False
 			while self.recompile_needed():
+				draft = self.draft_predicted(False)
 				self.must_compile = False
+				if not self.compile(draft):
+					return False
+				if not self.post_compile():
+					return False
+
+			# If the last compilation was a draft, the output is missing.
+			if draft:
+				msg.log(_("the last compilation was a draft"), pkg='latex')
 				if not self.compile():
 					return False
 				if not self.post_compile():
@@ -1305,6 +2048,31 @@ class LaTeXDep (Node):
 			self.date = int(time.time())
 		return True
 
+	def draft_predicted (self, first):
+		"""
+		Returns true if the compilation that is about to happen can be run in
+		draft mode, because another one is expected after it. This is the
+		case when a module just ran a tool whose results the compilation will
+		read, which usually changes the aux file, or for the first compilation
+		(when 'first' is true) of a document that has no aux file yet and
+		uses a bibliography, an index or a table of contents. A wrong guess
+		only costs one more compilation at the end.
+		"""
+		if self.vars["draftmode"] != "yes":
+			return False
+		if self.vars["engine"] != "pdfTeX" or self.products[0][-4:] != ".pdf":
+			return False
+		if not first:
+			return self.must_compile
+		if os.path.exists(self.target + ".aux"):
+			return False
+		if self.watched_files != {}:
+			return True
+		for name in "bibtex", "biblatex", "multibib", "makeidx", "index", "nomencl":
+			if self.modules.has_key(name):
+				return True
+		return False
+
 	def compile_needed (self):
 		"""
 		Returns true if a first compilation is needed. This method supposes
@@ -1319,7 +2087,12 @@ class LaTeXDep (Node):
 		if not os.path.exists(self.target + ".log"):
 			msg.debug(_("the log file does not exist"), pkg='latex')
 			return 1
-		if os.path.getmtime(self.products[0]) < os.path.getmtime(self.source()):
+		built = self.built_digests()
+		if built is not None:
+			if self.sources_changed(built, [self.source()]):
+				msg.debug(_("the source was modified"), pkg='latex')
+				return 1
+		elif os.path.getmtime(self.products[0]) < os.path.getmtime(self.source()):
 			msg.debug(_("the source is younger than the output file"), pkg='latex')
 			return 1
 		if self.log.read(self.target + ".log"):
@@ -1339,7 +2112,11 @@ class LaTeXDep (Node):
 			msg.debug(_("last compilation failed"), pkg='latex')
 			self.update_watches()
 			return 1
-		if self.deps_modified(os.path.getmtime(self.products[0])):
+		if self.draft_date is not None:
+			date = self.draft_date
+		else:
+			date = os.path.getmtime(self.products[0])
+		if self.deps_modified(date):
 			msg.debug(_("dependencies were modified"), pkg='latex')
 			self.update_watches()
 			return 1
@@ -1351,9 +2128,18 @@ class LaTeXDep (Node):
 			msg.debug(_("LaTeX asks to run again"), pkg='latex')
 			aux_changed = 0
 			for aux, md5 in self.aux_md5.items():
-				if md5 is not None and md5 != self.aux_old[aux]:
-					aux_changed = 1
-					break
+				if md5 is None or md5 == self.aux_old[aux]:
+					continue
+				reason = aux_change(self.aux_data_old.get(aux),
+					self.aux_data.get(aux))
+				if reason is None:
+					msg.debug(_("%s changed, but not in a way that affects "
+						"the output") % msg.simplify(aux), pkg='latex')
+					continue
+				msg.debug(_("in %s, %s") % (msg.simplify(aux), reason),
+					pkg='latex')
+				aux_changed = 1
+				break
 			if not aux_changed:
 				msg.debug(_("but the aux files are unchanged"), pkg='latex')
 				return 0
@@ -1364,8 +2150,16 @@ class LaTeXDep (Node):
 	def deps_modified (self, date):
 		"""
 		Returns true if any of the dependencies is younger than the specified
-		date.
-		"""
+		date. When using hashes, the contents of the dependencies are compared
+		with those of the last compilation (or the last successful build)
+		instead.
+		"""
+		digests = self.compiled_digests
+		if digests is None:
+			digests = self.built_digests()
+		if digests is not None:
+			return self.sources_changed(digests,
+				[name for name in self.sources if name not in self.not_included])
 		for name in self.sources:
 			if name in self.not_included:
 				continue
@@ -1389,19 +2183,21 @@ class LaTeXDep (Node):
 		another compilation has to be done.
 		"""
 		if os.path.exists(file):
-			self.watched_files[file] = md5_file(file)
+			self.watched_files[file] = md5_watched(file)
 		else:
 			self.watched_files[file] = None
 
 	def update_watches (self):
 		"""
 		Update the MD5 sums of all files watched, and return the name of one
-		of the files that changed, or None of they didn't change.
+		of the files that changed, or None of they didn't change. In aux
+		files, comments and other lines that cannot change the output are
+		not taken into account (see 'md5_watched').
 		"""
 		changed = None
 		for file in self.watched_files.keys():
 			if os.path.exists(file):
-				new = md5_file(file)
+				new = md5_watched(file)
 				if self.watched_files[file] != new:
 					changed = file
 				self.watched_files[file] = new
@@ -23,6 +23,12 @@ re_input = re.compile("input\\s+(?P<file>[^\\s;]+)")
 re_mpext = re.compile("[0-9]+|mpx|log")
 re_mpxerr = re.compile("% line (?P<line>[0-9]+) (?P<file>.*)$")
 
+# The environment variables that change the output of MetaPost, by deciding
+# which inputs and fonts it finds or how it typesets labels. Their values are
+# part of the key of the conversion cache.
+cache_variables = ("TEXINPUTS", "MPINPUTS", "MFINPUTS", "TFMFONTS", "TEX",
+	"MPXCOMMAND", "MPTEXPRE")
+
 class MPLogCheck (LogCheck):
 	"""
 	This class adapats the LogCheck class from the main program to the case of
@@ -37,6 +43,7 @@ class MPLogCheck (LogCheck):
 		The read() method in LogCheck checks that the log is produced by TeX,
 		here we check that it is produced by MetaPost.
 		"""
+		self.close()
 		file = open(name)
 		line = file.readline()
 		if not line:
@@ -45,8 +52,7 @@ class MPLogCheck (LogCheck):
 		if line.find("This is MetaPost,") == -1:
 			file.close()
 			return 1
-		self.lines = file.readlines()
-		file.close()
+		self.load(file)
 		return 0
 
 	def continued (self, line):
@@ -158,6 +164,12 @@ class Dep (Node):
 				self.include(m.group("file"), list)
 		fd.close()
 
+	def cache_key (self):
+		# The command only refers to the base name of the source.
+		env = [(name, self.penv.get(name, os.getenv(name)))
+			for name in cache_variables]
+		return repr(("mpost", self.cmd, env))
+
 	def run (self):
 		"""
 		Run Metapost from the source file's directory, so that figures are put
@@ -210,12 +222,13 @@ class Dep (Node):
 # uses a global variable, and this is authentically BAD. Therefore it deserves
 # a big fat huge FIXME. Graphics modules should proably be encapsuled in
 # classes the same way as standard Rubber modules, that would help for this
-# problem.
+# problem. Since the module is shared by all documents, nodes from another
+# dependency set are ignored.
 
 files = {}
 
 def convert (source, target, context, set):
-	if source in files:
+	if source in files and files[source].set is set:
 		dep = files[source]
 		dep.add_product(target)
 	else:
@@ -2,17 +2,208 @@
 This module contains code for handling dependency graphs.
 """
 
-import os, time
+import os, sys, time
+import gc, marshal
+import hashlib, shutil
+import threading
 from subprocess import Popen
 
-from rubber.util import _, msg
+from rubber import util
+from rubber.util import _, msg, md5_file
+
+# The version of the format of the files written by 'Set.save', to be
+# increased when the layout of the data changes.
+
+db_format = 3
+
+def valid_db (data):
+	"""
+	Check that data read from a build database has the layout written by
+	'Set.save'. The file is in the format of the module 'marshal', which can
+	only hold plain values (strings, numbers, tuples, lists, dictionaries),
+	so reading it cannot run code, but it comes from the document's
+	directory and may still be anything.
+	"""
+	if type(data) is not dict or data.get("format") != db_format:
+		return False
+	for key in "digests", "built", "scans":
+		if type(data.get(key)) is not dict:
+			return False
+	if data.get("graph") is not None and type(data["graph"]) is not dict:
+		return False
+	for entry in data["digests"].values():
+		if type(entry) is not tuple or len(entry) != 2:
+			return False
+	for digests in data["built"].values():
+		if type(digests) is not dict:
+			return False
+	for record in data["scans"].values():
+		if type(record) is not tuple or len(record) != 4 \
+				or type(record[0]) is not str:
+			return False
+	return True
 
 class Set (dict):
 	"""
 	Represents a set of dependency nodes. Nodes can be accessed by absolute
-	path name using the dictionary interface.
+	path name using the dictionary interface. The attribute 'jobs' is the
+	maximum number of nodes that 'Node.make' may build at the same time.
+
+	If the attribute 'use_hash' is true, the freshness of nodes is decided
+	by comparing the digests of their sources with those recorded at the
+	last successful build, instead of comparing modification dates. The
+	records can be kept between runs using the methods 'load' and 'save',
+	along with a snapshot of the whole graph (see 'snapshot') and the
+	indices of parsed sources (see 'LaTeXDep.parse_file').
+
+	If the attribute 'cache' is not None, it is the path of a directory
+	where the products of conversions are kept, so that identical
+	conversions, even for other documents, are not done again (see
+	'Node.cached_run').
 	"""
-	pass
+	def __init__ (self):
+		dict.__init__(self)
+		self.jobs = 1
+		self.use_hash = False
+		self.built = {}
+		self.graph = None
+		self.scans = {}
+		self.cache = None
+
+	def status (self, name):
+		"""
+		Return the size and date of the given file as a pair, or None if the
+		file does not exist.
+		"""
+		try:
+			st = os.stat(name)
+		except OSError:
+			return None
+		return (st.st_size, st.st_mtime)
+
+	def digest (self, name):
+		"""
+		Return the MD5 digest of the given file, or None if the file does not
+		exist. Digests are cached by 'md5_file', so that a file is only read
+		again when its status changes.
+		"""
+		try:
+			return md5_file(name)
+		except (IOError, OSError):
+			return None
+
+	def snapshot (self, node, watched=[]):
+		"""
+		Return a description of the graph below the given node, with the
+		state of all its files: the digests of the leaves and of the files
+		in the list 'watched', and the status of the products of the other
+		nodes. The result can be checked later by 'check_snapshot'.
+		"""
+		graph = []
+		contents = {}
+		status = {}
+		seen = {}
+		todo = [node]
+		while todo != []:
+			node = todo.pop()
+			if seen.has_key(id(node)):
+				continue
+			seen[id(node)] = None
+			graph.append((node.__class__.__name__, node.products[:],
+				node.sources[:]))
+			for name in node.products:
+				if node.is_leaf():
+					contents[name] = self.digest(name)
+				else:
+					status[name] = self.status(name)
+			todo.extend(node.source_nodes())
+		for name in watched:
+			contents[name] = self.digest(name)
+		return { "graph": graph, "contents": contents, "status": status }
+
+	def check_snapshot (self, snapshot):
+		"""
+		Check that the files described in a snapshot did not change since it
+		was made, i.e. that all sources have the same contents and that all
+		products are in the same state.
+		"""
+		for name, digest in snapshot["contents"].items():
+			if self.digest(name) != digest:
+				msg.log(_("%s has changed") % msg.simplify(name))
+				return False
+		for name, status in snapshot["status"].items():
+			if self.status(name) != status:
+				msg.log(_("%s has changed") % msg.simplify(name))
+				return False
+		return True
+
+	def load (self, name):
+		"""
+		Read the digest records and the snapshot of the graph from the given
+		file, if it exists. The digests cached by 'md5_file' are restored as
+		well. An invalid file, or one written in another format, is silently
+		ignored.
+
+		The indices of sources are made of many small tuples, the garbage
+		collector is disabled while they are read, since it would spend most
+		of the time scanning them for nothing.
+		"""
+		collect = gc.isenabled()
+		gc.disable()
+		try:
+			try:
+				file = open(name, "rb")
+				try:
+					data = marshal.load(file)
+				finally:
+					file.close()
+			except (IOError, EOFError, ValueError, TypeError):
+				return
+		finally:
+			if collect:
+				gc.enable()
+		if not valid_db(data):
+			return
+		digests = data["digests"]
+		self.built = data["built"]
+		self.graph = data["graph"]
+		self.scans = data["scans"]
+		for fname, entry in digests.items():
+			if not util.md5_cache.has_key(fname):
+				util.md5_cache[fname] = entry
+		msg.log(_("build database read from %s") % msg.simplify(name))
+
+	def save (self, name):
+		"""
+		Write the digest records, the snapshot of the graph and the indices
+		of sources into the given file. Only the entries for the files of
+		this set are written, including the digests cached by 'md5_file',
+		since the caches of the process may be shared by several documents.
+		"""
+		names = dict.fromkeys(self.keys())
+		if self.graph is not None:
+			names.update(self.graph["contents"])
+		digests = {}
+		scans = {}
+		for fname in names:
+			if util.md5_cache.has_key(fname):
+				digests[fname] = util.md5_cache[fname]
+			if self.scans.has_key(fname):
+				scans[fname] = self.scans[fname]
+		try:
+			file = open(name, "wb")
+			try:
+				marshal.dump({
+					"format": db_format,
+					"digests": digests,
+					"built": self.built,
+					"graph": self.graph,
+					"scans": scans },
+					file, 2)
+			finally:
+				file.close()
+		except (IOError, ValueError):
+			msg.warn(_("cannot write %s") % name)
 
 # constants for the return value of Node.make:
 
@@ -119,6 +310,39 @@ class Node (object):
 		"""
 		return self.sources == []
 
+	def source_digests (self):
+		"""
+		Return a dictionary that associates the current digest of each source
+		file of this node to its name.
+		"""
+		digests = {}
+		for name in self.sources:
+			digests[name] = self.set.digest(name)
+		return digests
+
+	def built_digests (self):
+		"""
+		Return the digests of the sources recorded at the last successful
+		build of this node, or None if there is no such record or if the
+		dependency set does not use hashes.
+		"""
+		if not self.set.use_hash or self.products == []:
+			return None
+		return self.set.built.get(self.products[0])
+
+	def sources_changed (self, digests, names=None):
+		"""
+		Return true if the contents of some sources differ from the digests
+		in the given dictionary. The optional argument is the list of
+		sources to check, by default all the sources are checked.
+		"""
+		if names is None:
+			names = self.sources
+		for name in names:
+			if digests.get(name) != self.set.digest(name):
+				return True
+		return False
+
 	def should_make (self):
 		"""
 		Check the dependencies. Return true if this node has to be recompiled,
@@ -126,6 +350,9 @@ class Node (object):
 		"""
 		if not self.date:
 			return True
+		built = self.built_digests()
+		if built is not None:
+			return self.sources_changed(built)
 		for source in self.source_nodes():
 			if source.date > self.date:
 				return True
@@ -153,40 +380,75 @@ class Node (object):
 		# Make the sources
 
 		self.failed_dep = None
-		must_make = force
-		for source in self.source_nodes():
-			ret = source.make()
-			if ret == ERROR:
-				self.making = False
-				self.failed_dep = source.failed_dep
-				return ERROR
-			elif ret == CHANGED:
-				must_make = True
+		ret = self.make_sources()
+		if ret == ERROR:
+			self.making = False
+			return ERROR
 
 		# Make this node if necessary
 
-		if must_make or self.should_make():
-			if force:
-				ok = self.force_run()
-			else:
-				ok = self.run()
-			if not ok:
-				self.making = False
-				self.failed_dep = self
+		ret = self.update(force or ret == CHANGED, force)
+		self.making = False
+		return ret
+
+	def make_sources (self):
+		"""
+		Make all the sources of this node. If the dependency set allows
+		several jobs, independent sources are made concurrently by a
+		Scheduler, otherwise they are made one after the other. The return
+		value is ERROR if some source failed (in which case 'failed_dep' is
+		set accordingly), CHANGED if some source was recompiled and UNCHANGED
+		otherwise.
+		"""
+		if self.set.jobs > 1:
+			ret, self.failed_dep = Scheduler(self.set.jobs).make(
+					self.source_nodes())
+			return ret
+
+		ret = UNCHANGED
+		for source in self.source_nodes():
+			res = source.make()
+			if res == ERROR:
+				self.failed_dep = source.failed_dep
 				return ERROR
+			elif res == CHANGED:
+				ret = CHANGED
+		return ret
 
-			# Here we must take the integer part of the value returned by
-			# time.time() because the modification times for files, returned
-			# by os.path.getmtime(), is an integer. Keeping the fractional
-			# part could lead to errors in time comparison when a compilation
-			# is shorter than one second...
+	def update (self, must_make, force=False):
+		"""
+		Build this node, assuming that all its sources are made. The node is
+		rebuilt if 'must_make' is true or if 'should_make' says so. The
+		return value is as for 'make'. If 'force' is true, the method
+		'force_run' is used instead of 'run'.
+		"""
+		if must_make and not force and self.built_digests() is not None:
+			# When using hashes, sources that were rebuilt only matter if
+			# their contents actually changed.
+			must_make = False
+		if not (must_make or self.should_make()):
+			return UNCHANGED
 
-			self.date = int(time.time())
-			self.making = False
-			return CHANGED
+		if force:
+			ok = self.force_run()
+		else:
+			ok = self.cached_run()
+		if not ok:
+			self.failed_dep = self
+			return ERROR
+		for name in self.products:
+			util.forget_directory(name)
 
-		self.making = False
-		return UNCHANGED
+		# Here we must take the integer part of the value returned by
+		# time.time() because the modification times for files, returned
+		# by os.path.getmtime(), is an integer. Keeping the fractional
+		# part could lead to errors in time comparison when a compilation
+		# is shorter than one second...
+
+		self.date = int(time.time())
+		if self.set.use_hash and self.products != []:
+			self.set.built[self.products[0]] = self.source_digests()
+		return CHANGED
 
 	def run (self):
 		"""
@@ -203,6 +465,82 @@ class Node (object):
 		"""
 		return self.run()
 
+	def cache_key (self):
+		"""
+		Return a string that describes what this node does to its sources,
+		independently of where the files are, or None if the products of
+		this node cannot be kept in the conversion cache. Two nodes with the
+		same key must produce the same files from sources with the same
+		contents. By default, nodes are not cached.
+		"""
+		return None
+
+	def cache_entry (self):
+		"""
+		Return the path of the entry of the conversion cache for this node
+		in its current state, or None if it cannot be cached. The entry is
+		named after the digest of the key of the node, the names of its
+		products and the contents of its sources.
+		"""
+		if self.set.cache is None:
+			return None
+		key = self.cache_key()
+		if key is None:
+			return None
+		names = map(os.path.basename, self.products)
+		if len(dict.fromkeys(names)) != len(names):
+			return None
+		m = hashlib.md5(key)
+		for name in sorted(names):
+			m.update("\0" + name)
+		for name in self.sources:
+			digest = self.set.digest(name)
+			if digest is None:
+				return None
+			m.update("\0" + digest)
+		return os.path.join(self.set.cache, m.hexdigest())
+
+	def cached_run (self):
+		"""
+		Build this node using the conversion cache: if the cache contains the
+		products of an identical conversion, they are copied instead of
+		calling 'run', otherwise the products made by 'run' are stored in
+		the cache. Entries are written in a temporary directory first, so
+		that concurrent builds sharing the cache never see partial entries.
+		"""
+		entry = self.cache_entry()
+		if entry is None:
+			return self.run()
+
+		if os.path.isdir(entry):
+			try:
+				for name in self.products:
+					shutil.copyfile(
+						os.path.join(entry, os.path.basename(name)), name)
+			except (IOError, OSError):
+				pass
+			else:
+				msg.progress(_("using cached %s") %
+					", ".join(map(msg.simplify, self.products)))
+				return True
+
+		if not self.run():
+			return False
+
+		temp = "%s-%d-%d.tmp" % (entry, os.getpid(), id(self))
+		try:
+			if not os.path.isdir(self.set.cache):
+				os.makedirs(self.set.cache)
+			os.mkdir(temp)
+			for name in self.products:
+				shutil.copyfile(name,
+					os.path.join(temp, os.path.basename(name)))
+			os.rename(temp, entry)
+		except (IOError, OSError):
+			# Another build may have stored the same entry meanwhile.
+			shutil.rmtree(temp, True)
+		return True
+
 	def failed (self):
 		"""
 		Return a reference to the node that caused the failure of the last
@@ -229,6 +567,8 @@ class Node (object):
 		for source in self.source_nodes():
 			source.clean()
 		self.date = None
+		if self.products != [] and self.set.built.has_key(self.products[0]):
+			del self.set.built[self.products[0]]
 
 	def leaves (self):
 		"""
@@ -272,6 +612,13 @@ class Shell (Node):
 		Node.__init__(self, set, products, sources)
 		self.command = command
 
+	def cache_key (self):
+		# The files of the node are only referred to by their base name.
+		files = {}
+		for name in self.products + self.sources:
+			files[name] = os.path.basename(name)
+		return repr(("Shell", [files.get(arg, arg) for arg in self.command]))
+
 	def run (self):
 		msg.progress(_("running: %s") % ' '.join(self.command))
 		process = Popen(self.command)
@@ -279,3 +626,148 @@ class Shell (Node):
 			msg.error(_("execution of %s failed") % self.command[0])
 			return False
 		return True
+
+class Scheduler (object):
+	"""
+	This class makes a group of nodes, with all their dependencies, using up
+	to a given number of concurrent jobs. The graph below the nodes is sorted
+	topologically and each node is built (using its method 'update') as soon
+	as all its sources are made, so that independent nodes, like figure
+	conversions, are built at the same time. The semantics is that of
+	'Node.make': when a node fails, no new node is started, and the nodes
+	that depend on it fail as well. If 'keep_going' is true, the nodes that
+	do not depend on a failed node are still built, and the result of each
+	node can be checked afterwards with 'result'.
+	"""
+	def __init__ (self, jobs, keep_going=False):
+		self.jobs = jobs
+		self.keep_going = keep_going
+		self.cond = threading.Condition()
+
+	def visit (self, node):
+		"""
+		Register the given node and, recursively, its sources, in dependency
+		order. Nodes that are currently being made (i.e. the callers of the
+		scheduler) are ignored, as 'Node.make' does for cyclic dependencies.
+		"""
+		key = id(node)
+		if key in self.waiting or node.making:
+			return
+		self.waiting[key] = 0
+		self.users[key] = []
+		for source in node.source_nodes():
+			self.visit(source)
+			if id(source) not in self.sorted:
+				if id(source) in self.waiting:
+					msg.warn(_("cyclic dependency on %s, skipping it") %
+						msg.simplify(source.products[0]))
+				continue
+			self.waiting[key] += 1
+			self.users[id(source)].append(node)
+		self.sorted[key] = None
+		self.nodes.append(node)
+
+	def make (self, nodes):
+		"""
+		Make the given nodes. The return value is a pair (ret, failed) where
+		'ret' is ERROR if some node failed, CHANGED if something was
+		recompiled and UNCHANGED otherwise, and 'failed' is the node that
+		caused the failure (or None).
+		"""
+		self.nodes = []
+		self.sorted = {}
+		self.waiting = {}
+		self.users = {}
+		self.results = {}
+		self.running = 0
+		self.failed = False
+		self.exc_info = None
+
+		for node in nodes:
+			self.visit(node)
+		self.ready = [node for node in self.nodes if self.waiting[id(node)] == 0]
+
+		self.cond.acquire()
+		try:
+			while True:
+				while self.ready and self.running < self.jobs \
+						and not (self.failed and not self.keep_going):
+					node = self.ready.pop(0)
+					node.making = True
+					node.failed_dep = None
+					self.running += 1
+					thread = threading.Thread(target=self.build, args=(node,))
+					thread.setDaemon(True)
+					thread.start()
+				if self.running == 0:
+					break
+				# A timeout is used so that keyboard interrupts are received.
+				self.cond.wait(1)
+		finally:
+			self.cond.release()
+
+		if self.exc_info is not None:
+			raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+
+		ret = UNCHANGED
+		for node in nodes:
+			res = self.results.get(id(node), UNCHANGED)
+			if res == ERROR:
+				return ERROR, node.failed_dep
+			elif res == CHANGED:
+				ret = CHANGED
+		return ret, None
+
+	def result (self, node):
+		"""
+		Return the result of making the given node in the last call to
+		'make', as for 'Node.make'.
+		"""
+		return self.results.get(id(node), UNCHANGED)
+
+	def build (self, node):
+		"""
+		Build a single node whose sources are all made. This is called in a
+		separate thread for each node.
+		"""
+		must_make = False
+		for source in node.source_nodes():
+			if self.results.get(id(source)) == CHANGED:
+				must_make = True
+		try:
+			try:
+				ret = node.update(must_make)
+			except:
+				self.exc_info = sys.exc_info()
+				ret = ERROR
+		finally:
+			node.making = False
+			self.cond.acquire()
+			try:
+				self.done(node, ret)
+				if ret == ERROR:
+					self.failed = True
+				self.running -= 1
+				self.cond.notify()
+			finally:
+				self.cond.release()
+
+	def done (self, node, ret):
+		"""
+		Record the result of building a node and update the set of nodes
+		ready to be built. If the node failed, the nodes that depend on it
+		fail as well, reporting the same node as the cause.
+		"""
+		self.results[id(node)] = ret
+		for user in self.users[id(node)]:
+			if id(user) in self.results:
+				continue
+			if ret == ERROR:
+				user.failed_dep = node.failed_dep
+				if user in self.ready:
+					self.ready.remove(user)
+				self.done(user, ERROR)
+				continue
+			self.waiting[id(user)] -= 1
+			if self.waiting[id(user)] == 0:
+				self.ready.append(user)
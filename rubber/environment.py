@@ -55,9 +55,9 @@ class Environment:
 		"""
 		for path in self.path:
 			test = os.path.join(path, name)
-			if suffix and os.path.exists(test + suffix) and os.path.isfile(test + suffix):
+			if suffix and file_exists(test + suffix) and os.path.isfile(test + suffix):
 				return test + suffix
-			elif os.path.exists(test) and os.path.isfile(test):
+			elif file_exists(test) and os.path.isfile(test):
 				return test
 		return None
 
@@ -112,6 +112,38 @@ class Environment:
 			self.main.set_source(src)
 		return 0
 
+	def save_state (self, key):
+		"""
+		Record a snapshot of the dependency graph of the final document in the
+		dependency set, so that a later run with the same settings can check
+		that nothing has to be done without parsing the sources. The argument
+		'key' describes the settings of the build (typically the command
+		line). The aux files and watched files of the document are recorded
+		along with the graph, as well as the list of modules, for reference.
+		"""
+		main = self.main
+		watched = main.aux_md5.keys() + main.watched_files.keys()
+		state = self.depends.snapshot(self.final, watched)
+		state["key"] = key
+		state["modules"] = main.modules.objects.keys()
+		self.depends.graph = state
+
+	def check_state (self, key):
+		"""
+		Check if the snapshot recorded by 'save_state' is still valid for the
+		given settings, i.e. if none of the files involved in the building
+		process changed since then. If this is the case, the document is up
+		to date and does not have to be parsed.
+		"""
+		state = self.depends.graph
+		if state is None or state["key"] != key:
+			return False
+		if not self.depends.check_snapshot(state):
+			return False
+		msg.log(_("the build database is up to date (modules: %s)") %
+				", ".join(state["modules"]))
+		return True
+
 	def conv_set (self, file, vars):
 		"""
 		Define preferences for the generation of a given file. The argument
@@ -160,7 +192,7 @@ class Environment:
 
 			# Check if the target exists.
 
-			if prefs is None and os.path.exists(t):
+			if prefs is None and file_exists(t):
 				if last is not None and last["cost"] <= 0:
 					break
 				msg.log(_("`%s' is `%s', no rule applied") % (target, t))
@@ -196,9 +228,10 @@ class Environment:
 		of arguments for the program, `prog[0]' is the program name. The `env'
 		argument is a dictionary with definitions that should be added to the
 		environment when running the program. The standard output is passed
-		line by line to the `out' function (or discarded by default). In the
-		optional argument `kpse' is true, the error output is parsed and
-		messages from Kpathsea are processed (to indicate e.g. font
+		line by line to the `out' function (or discarded by default) as it is
+		produced, and the program is terminated if this function returns
+		true. In the optional argument `kpse' is true, the error output is
+		parsed and messages from Kpathsea are processed (to indicate e.g. font
 		compilation), otherwise the error output is kept untouched.
 		"""
 		msg.info(_("executing: %s") % string.join(prog))
@@ -243,8 +276,13 @@ class Environment:
 			thread.start_new_thread(parse_kpse, ())
 
 		if out is not None:
-			for line in process.stdout.readlines():
-				out(line)
+			for line in iter(process.stdout.readline, ""):
+				if out(line):
+					msg.log(_("terminating process %d (%s)")
+						% (process.pid, prog[0]))
+					process.terminate()
+					break
+			process.stdout.close()
 		else:
 			process.stdout.readlines()
 
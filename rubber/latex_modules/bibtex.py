@@ -17,10 +17,10 @@ import re, string
 from subprocess import Popen, PIPE
 
 from rubber import _, msg
+from rubber.util import file_exists
 
 re_bibdata = re.compile(r"\\bibdata{(?P<data>.*)}")
 re_citation = re.compile(r"\\citation{(?P<cite>.*)}")
-re_undef = re.compile("LaTeX Warning: Citation `(?P<cite>.*)' .*undefined.*")
 
 # The regular expression that identifies errors in BibTeX log files is heavily
 # heuristic. The remark is that all error messages end with a text of the form
@@ -85,7 +85,7 @@ class Bibliography:
 		"""
 		for dir in self.bib_path:
 			bib = join(dir, name + ".bib")
-			if exists(bib):
+			if file_exists(bib):
 				self.db[name] = bib
 				self.doc.add_source(bib)
 				self.doc.not_included.append(bib)
@@ -214,14 +214,7 @@ class Bibliography:
 		"""
 		Return the list of all undefined citations.
 		"""
-		cites = {}
-		for line in self.doc.log.lines:
-			match = re_undef.match(line)
-			if match:
-				cites[match.group("cite")] = None
-		list = cites.keys()
-		list.sort()
-		return list
+		return self.doc.log.undefined_citations()
 
 	def post_compile (self):
 		"""
@@ -18,8 +18,9 @@ import os, os.path
 import string, re
 
 from rubber import _, msg
-from rubber.util import parse_keyval
+from rubber.util import parse_keyval, file_exists
 from rubber.tex import parse_string
+from rubber.depend import ERROR, Scheduler
 
 # default suffixes for each device driver (taken from the .def files)
 
@@ -163,10 +164,10 @@ def find_input (name):
 	"""
 	for prefix in prefixes:
 		test = prefix + name
-		if exists(test):
+		if file_exists(test):
 			return test
 		for suffix in suffixes:
-			if exists(test + suffix):
+			if file_exists(test + suffix):
 				return test + suffix
 	return None
 
@@ -175,9 +176,20 @@ def find_input (name):
 def pre_compile ():
 	# Pre-compilation means running all needed conversions. This is not done
 	# through the standard dependency mechanism because we do not want to
-	# interrupt compilation when a graphic is not found.
+	# interrupt compilation when a graphic is not found. Independent
+	# conversions run at the same time if several jobs are allowed, and the
+	# failures are all reported at the end.
+	scheduler = Scheduler(doc.env.depends.jobs, keep_going=True)
+	scheduler.make(files)
+	failed = []
 	for node in files:
-		node.make()
+		if scheduler.result(node) == ERROR and node not in failed:
+			failed.append(node)
+	for node in failed:
+		msg.warn(_("cannot make graphics %s") %
+			", ".join(map(msg.simplify, node.products)), pkg='graphics')
+		if node.failed() is not None:
+			msg.display_all(node.failed().get_errors())
 	return True
 
 def clean ():
@@ -73,10 +73,12 @@ for i in range(0,26):
 	catcodes[chr(ord('A')+i)] = LETTER
 	catcodes[chr(ord('a')+i)] = LETTER
 
-class Position:
+class Position (object):
 	"""
 	A class to represent positions in a source file.
 	"""
+	__slots__ = ('file', 'line', 'char')
+
 	def __init__ (self, file=None, line=None, char=None):
 		self.file = file
 		self.line = line
@@ -84,7 +86,7 @@ class Position:
 	def __str__ (self):
 		text = ''
 		if self.file:
-			text = file + ':'
+			text = self.file + ':'
 		if self.line is not None:
 			if text != '':
 				text += ':'
@@ -93,12 +95,14 @@ class Position:
 				text += ':%d' % self.char
 		return text
 
-class Token:
+class Token (object):
 	"""
 	The class used to represent tokens. Objects contain a catcode, a value
 	(for control sequences) and the raw text that represents them in the input
 	file.
 	"""
+	__slots__ = ('cat', 'val', 'raw', 'pos')
+
 	def __init__ (self, cat, val=None, raw=None, pos=None):
 		self.cat = cat
 		self.val = val
@@ -358,11 +362,21 @@ class Parser (ParserBase):
 	"""
 	A parser for TeX code that reads its input from a file object.
 
+	The input is read line by line: the attribute 'line' holds the current
+	line and 'index' is the position of the next character in it, so that
+	reading does not copy the rest of the line for each character. Runs of
+	letters in control sequence names, and of characters with no special
+	meaning in arguments, are read with regular expressions. These are made
+	from the catcodes when the parser is created, the method
+	'update_catcodes' must be called if the catcodes are changed later.
+
 	The class also provides a hook feature: the method 'set_hooks' declares a
 	set of control sequence names, and the method 'next_hook' parses the input
 	until it finds a control sequence from this set, ignoring all other
 	tokens. This advantage of this method is that is is much faster than
-	reading tokens one by one.
+	reading tokens one by one: the rest of the input is read at once and
+	searched for control sequences with a single regular expression, which
+	does not depend on the hooks, so that hooks can be added at any time.
 	"""
 	def __init__ (self, input, coding=None):
 		"""
@@ -377,16 +391,47 @@ class Parser (ParserBase):
 		else:
 			self.input = codecs.lookup(coding).streamreader(input)
 		self.line = ""
+		self.index = 0
 		self.pos_line = 1
-		self.pos_char = 1
-		self.next_char = None
+		self.hooks = {}
+		self.update_catcodes()
+
+	def update_catcodes (self):
+		"""
+		Compute the regular expressions used for reading, according to the
+		current catcodes.
+		"""
+		self.re_letters = re.compile(self.re_cat(LETTER) + '+')
+		self.re_spaces = re.compile(self.re_cat(SPACE) + '*')
+		special = [char for char,code in self.catcodes.items()
+			if code in (ESCAPE, OPEN, CLOSE, MATH)]
+		self.re_text = self.re_run(special)
+		if ']' not in special:
+			special.append(']')
+		self.re_optional_text = self.re_run(special)
+		self.re_hook = re.compile(self.re_cat(ESCAPE)
+			+ '(?:(?P<name>' + self.re_cat(LETTER) + '+)'
+			+ self.re_cat(SPACE) + '*|(?P<pair>' + self.re_cat(ESCAPE, COMMENT)
+			+ ')|[\\s\\S]|$)|' + self.re_cat(COMMENT))
+
+	def re_run (self, special):
+		"""
+		Return a regular expression that matches text made of characters that
+		are not in the given list and of control sequences, i.e. the text up
+		to the first special character that is not escaped.
+		"""
+		plain = re_set(special, True) + '*'
+		return re.compile(plain + '(?:' + self.re_cat(ESCAPE) + '[\\s\\S]'
+			+ plain + ')*')
 
 	def read_line (self):
 		"""
 		Reads a line of input and sets the attribute 'line' with it. Returns
 		True if reading succeeded and False if it failed.
 		"""
+		self.index = 0
 		if self.input is None:
+			self.line = ""
 			return False
 		self.line = self.input.readline()
 		if self.line == "":
@@ -398,53 +443,140 @@ class Parser (ParserBase):
 		Get the next character from the input and its catcode (without parsing
 		control sequences).
 		"""
-		if self.next_char is not None:
-			t = self.next_char
-			self.next_char = None
-			return t
-
-		while self.line == "":
+		while self.index >= len(self.line):
 			if not self.read_line():
 				return Token(EOF)
-		c = self.line[0]
-		self.line = self.line[1:]
-
-		pos = Position(line=self.pos_line, char=self.pos_char)
+		c = self.line[self.index]
+		pos = Position(line=self.pos_line, char=self.index + 1)
+		self.index += 1
 		if c == '\n':
 			self.pos_line += 1
-			self.pos_char = 1
-		else:
-			self.pos_char += 1
-
-		return Token(self.catcode(c), raw=c, pos=pos)
+		return Token(self.catcodes.get(c, OTHER), raw=c, pos=pos)
 
 	def read_token (self):
 		"""
 		Get the next token from the input.
 		"""
-		token = self.read_char()
-		if token.cat != ESCAPE:
-			if token.cat in (LETTER, OTHER):
-				token.val = token.raw
-			return token
-		pos = token.pos
-		raw = token.raw
-		token = self.read_char()
-		if token.cat != LETTER:
-			token.cat = CSEQ
-			token.val = token.raw
-			token.raw = raw + token.raw
-			return token
-		name = ""
-		while token.cat == LETTER:
-			raw += token.raw
-			name += token.raw
-			token = self.read_char()
-		while token.cat == SPACE:
-			raw += token.raw
-			token = self.read_char()
-		self.next_char = token
-		return Token(CSEQ, name, raw, pos=pos)
+		while self.index >= len(self.line):
+			if not self.read_line():
+				return Token(EOF)
+		line = self.line
+		index = self.index
+		c = line[index]
+		cat = self.catcodes.get(c, OTHER)
+		pos = Position(line=self.pos_line, char=index + 1)
+		self.index = index + 1
+		if c == '\n':
+			self.pos_line += 1
+		if cat != ESCAPE:
+			if cat == LETTER or cat == OTHER:
+				return Token(cat, c, c, pos)
+			return Token(cat, None, c, pos)
+
+		# A control sequence: either a single non-letter, or a name made of
+		# letters followed by optional spaces. Names are read in runs and
+		# may extend across the end of the buffer.
+
+		if self.index >= len(line):
+			if not self.read_line():
+				return Token(CSEQ, '', c, pos)
+			line = self.line
+		match = self.re_letters.match(line, self.index)
+		if match is None:
+			char = line[self.index]
+			self.index += 1
+			if char == '\n':
+				self.pos_line += 1
+			return Token(CSEQ, char, c + char, pos)
+		name = [match.group()]
+		raw = [c, match.group()]
+		self.index = match.end()
+		while True:
+			while self.index >= len(self.line):
+				if not self.read_line():
+					break
+			match = self.re_letters.match(self.line, self.index)
+			if match is None:
+				break
+			name.append(match.group())
+			raw.append(match.group())
+			self.index = match.end()
+		while True:
+			match = self.re_spaces.match(self.line, self.index)
+			if match.end() > self.index:
+				raw.append(match.group())
+				self.index = match.end()
+			if self.index < len(self.line) or not self.read_line():
+				break
+		return Token(CSEQ, ''.join(name), ''.join(raw), pos)
+
+	def read_text (self, regexp):
+		"""
+		Read a run of characters that match a regular expression (see
+		'update_catcodes') from the buffer, as the tokens they form
+		would be read, and return it. No text is read if tokens were put back.
+		"""
+		if self.next:
+			return ''
+		match = regexp.match(self.line, self.index)
+		if match.end() == self.index:
+			return ''
+		self.index = match.end()
+		self.last_is_math = 0
+		text = match.group()
+		self.pos_line += text.count('\n')
+		return text
+
+	def get_group_text (self):
+		"""
+		Get the list of tokens up to the next closing brace, and drop the
+		closing brace. Return the list as a string.
+		"""
+		value = []
+		level = 1
+		while 1:
+			value.append(self.read_text(self.re_text))
+			token = self.get_token()
+			if token.cat == OPEN:
+				level += 1
+			elif token.cat == CLOSE:
+				level -= 1
+				if level == 0:
+					break
+			elif token.cat == EOF:
+				break
+			value.append(token.raw)
+		return ''.join(value)
+
+	def get_latex_optional_text (self):
+		"""
+		Check if a LaTeX-style optional argument is present. If such an
+		argument is present, return it as text, otherwise return None.
+		"""
+		next = self.get_token()
+
+		if next.cat != OTHER or next.raw != '[':
+			self.put_token(next)
+			return None
+
+		level = 0
+		value = []
+		while True:
+			value.append(self.read_text(self.re_optional_text))
+			token = self.get_token()
+			if token.cat == EOF:
+				break
+			if token.cat == OTHER and token.raw == ']' and level == 0:
+				break
+			if token.cat == OPEN:
+				level += 1
+			elif token.cat == CLOSE:
+				if level == 0:
+					break
+				level -= 1
+			value.append(token.raw)
+
+		return ''.join(value)
 
 	def re_cat (self, *cat):
 		"""
@@ -462,35 +594,59 @@ class Parser (ParserBase):
 
 	def set_hooks (self, names):
 		"""
-		Define the set of hooks for 'next_hook'.
+		Define the set of hooks for 'next_hook'. The names must be made of
+		letters.
 		"""
-		expr = '(' \
-			+ self.re_nocat(ESCAPE, COMMENT) + '|' \
-			+ self.re_cat(ESCAPE) + self.re_cat(ESCAPE, COMMENT) + ')*' \
-			+ '(?P<raw>' + self.re_cat(ESCAPE) \
-			+ '(?P<val>' + '|'.join(names) + ')' \
-			+ '(' + self.re_cat(SPACE) + '+|(?=' + self.re_nocat(LETTER) + ')|$))'
-		self.regex = re.compile(expr)
+		self.hooks = dict.fromkeys(names)
+
+	def add_hooks (self, names):
+		"""
+		Add names to the set of hooks for 'next_hook'.
+		"""
+		self.hooks.update(dict.fromkeys(names))
 
 	def next_hook (self):
 		"""
 		Ignore input until the next control sequence from the set defined by
 		'set_hooks'. Returns the associated token, or the EOF token if no hook
 		was found.
-		"""
-		while self.line == "":
-			if not self.read_line():
-				return Token(EOF)
+
+		As when reading line by line, a control sequence is only considered
+		if it is the first one after the current position in its line: the
+		rest of a line is skipped after any other control sequence (except
+		an escaped escape or comment character) and after a comment. The
+		line number is updated by counting the line ends that were skipped.
+		"""
+		if self.input is not None:
+			rest = self.input.read()
+			if rest != "":
+				self.line = self.line[self.index:] + rest
+				self.index = 0
+		text = self.line
+		pos = self.index
+		search = self.re_hook.search
 		while True:
-			match = self.regex.match(self.line)
-			if match is not None:
-				self.pos_char = match.end('raw') + 1
-				self.line = self.line[match.end('raw'):]
-				return Token(CSEQ, match.group('val'), match.group('raw'))
-			if not self.read_line():
-				return Token(EOF)
-			self.pos_line += 1
-			self.pos_char = 1
+			match = search(text, pos)
+			if match is None:
+				break
+			name = match.group('name')
+			if name is not None and self.hooks.has_key(name):
+				start = match.start()
+				self.pos_line += text.count('\n', self.index, start)
+				self.index = match.end()
+				pos = Position(line=self.pos_line,
+					char=start - text.rfind('\n', 0, start))
+				return Token(CSEQ, name, match.group(), pos)
+			if match.group('pair') is not None:
+				pos = match.end()
+				continue
+			pos = text.find('\n', match.start() + 1)
+			if pos < 0:
+				break
+			pos += 1
+		self.pos_line += text.count('\n', self.index)
+		self.index = len(text)
+		return Token(EOF)
 
 class ListParser (ParserBase):
 	"""
@@ -139,16 +139,120 @@ msg = Message()
 
 #-- Miscellaneous functions --{{{1
 
+# The digests computed by md5_file: each file name is associated with a pair
+# (key, digest) where the key is made of the device, inode, size and date of
+# the file when its digest was computed. This can be saved and restored to
+# keep the digests between runs.
+
+md5_cache = {}
+
 def md5_file (fname):
 	"""
-	Compute the MD5 sum of a given file.
+	Compute the MD5 sum of a given file. The file is read in binary chunks,
+	and the result is remembered as long as the device, inode, size and date
+	of the file do not change.
+	"""
+	file = open(fname, "rb")
+	try:
+		st = os.fstat(file.fileno())
+		key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+		entry = md5_cache.get(fname)
+		if entry is not None and entry[0] == key:
+			return entry[1]
+		m = hashlib.md5()
+		while 1:
+			data = file.read(1 << 16)
+			if not data:
+				break
+			m.update(data)
+	finally:
+		file.close()
+	digest = m.digest()
+	md5_cache[fname] = (key, digest)
+	return digest
+
+def file_status (fname):
+	"""
+	Return the device, inode, size and date of the given file as a tuple, or
+	None if the file does not exist. Two equal values mean that the file was
+	not modified in between, including when it was replaced by another one.
+	"""
+	try:
+		st = os.stat(fname)
+	except OSError:
+		return None
+	return (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+
+# The contents of the directories listed by 'list_directory': each absolute
+# path (not necessarily normalized) is associated with a pair (date, names)
+# where 'date' is the modification date of the directory when it was listed
+# (or None if it was too recent to be trusted) and 'names' is a dictionary of
+# the names of the files in the directory, in lower case (or None if it
+# cannot be listed). A date is too recent when it is less than
+# 'directory_delay' seconds old, since files created in the same tick would
+# not change it.
+
+directories = {}
+directory_delay = 1.0
+
+def list_directory (dir):
+	"""
+	Return a dictionary whose keys are the names of the files in the given
+	directory, in lower case, or None if it cannot be listed. The date of
+	the directory is checked each time, and the listing is read again when
+	it changes.
+	"""
+	if not os.path.isabs(dir):
+		dir = os.path.join(os.getcwd(), dir)
+	entry = directories.get(dir)
+	try:
+		date = os.stat(dir).st_mtime
+	except OSError:
+		directories[dir] = (None, None)
+		return None
+	if entry is not None and entry[0] == date:
+		return entry[1]
+	try:
+		names = dict.fromkeys([n.lower() for n in os.listdir(dir)])
+	except OSError:
+		names = None
+	if time.time() - date < directory_delay:
+		# Changes in the same tick as this listing would go unnoticed.
+		date = None
+	directories[dir] = (date, names)
+	return names
+
+def forget_directory (name):
+	"""
+	Forget the listing of the directory that contains the given file, so
+	that the next lookups see this file if it was just created. This may
+	be called by several threads at once.
+	"""
+	dir = os.path.dirname(os.path.abspath(name))
+	for key in directories.keys():
+		if os.path.normpath(key) == dir:
+			directories.pop(key, None)
+
+def file_exists (name):
+	"""
+	Check if the given file exists, like 'os.path.exists'. The listing of
+	its directory is checked first (see 'list_directory'), so that looking
+	for missing files in a directory, as when trying many suffixes and
+	search paths, does not access the file system for each of them. Names
+	are looked up in the listing regardless of case, and the file itself is
+	checked afterwards, so that the answer is that of the file system even
+	when it ignores case. Names that are not plain ASCII are always checked
+	on the file system, since it may also normalize them.
 	"""
-	m = hashlib.md5()
-	file = open(fname)
-	for line in file.readlines():
-		m.update(line)
-	file.close()
-	return m.digest()
+	dir, base = os.path.split(name)
+	try:
+		base.encode("ascii")
+	except UnicodeError:
+		return os.path.exists(name)
+	names = list_directory(dir or os.curdir)
+	if names is None or not names.has_key(base.lower()):
+		return False
+	return os.path.exists(name)
 
 
 #-- Keyval parsing --{{{1
@@ -238,8 +342,20 @@ class Variables (UserDict.DictMixin):
 	environment take precedence over parent environments, but changing the
 	value of a variable changes its value in the environment that actually
 	defines it.
+
+	Accesses do not walk up the stack: a variable is looked for in the
+	environment itself, then in the flattened scope of its parent, which
+	maps the name of every variable visible in the parent to the dictionary
+	of the environment that defines it, and values are read and written
+	there. Scopes are made when first needed, so that short-lived
+	environments with a few bindings, which are seldom used as parents, do
+	not need one. A scope can only become obsolete when a variable is
+	declared, so declarations increase the class attribute 'generation' and
+	scopes made in an older generation are made again when used.
 	"""
 
+	generation = 0
+
 	def __init__ (self, parent = None, items = {}):
 		"""
 		Create an environment, possibly with a parent environment, and initial
@@ -249,17 +365,35 @@ class Variables (UserDict.DictMixin):
 			raise ValueError()
 		self.parent = parent
 		self.dict = items
+		self.owners = None
+		self.owners_generation = -1
+
+	def scope (self):
+		"""
+		Return the flattened scope of the environment, i.e. a dictionary that
+		associates the name of each visible variable with the dictionary that
+		holds its value.
+		"""
+		if self.owners_generation != Variables.generation:
+			if self.parent is None:
+				owners = {}
+			else:
+				owners = self.parent.scope().copy()
+			for key in self.dict:
+				owners[key] = self.dict
+			self.owners = owners
+			self.owners_generation = Variables.generation
+		return self.owners
 
 	def __getitem__ (self, key):
 		"""
 		Get the value of a variable in the environment or its parents.
 		"""
-		object = self
-		while object is not None:
-			if object.dict.has_key(key):
-				return object.dict[key]
-			object = object.parent
-		raise KeyError
+		if self.dict.has_key(key):
+			return self.dict[key]
+		if self.parent is None:
+			raise KeyError(key)
+		return self.parent.scope()[key][key]
 
 	def __setitem__ (self, key, value):
 		"""
@@ -267,22 +401,43 @@ class Variables (UserDict.DictMixin):
 		assuming it is defined somewhere. Raises 'KeyError' if the variable is
 		not declared.
 		"""
-		object = self
-		while object is not None:
-			if object.dict.has_key(key):
-				object.dict[key] = value
-				return
-			object = object.parent
-		raise KeyError
+		if self.dict.has_key(key):
+			self.dict[key] = value
+		elif self.parent is None:
+			raise KeyError(key)
+		else:
+			self.parent.scope()[key][key] = value
+
+	def has_key (self, key):
+		if self.dict.has_key(key):
+			return True
+		return self.parent is not None and self.parent.scope().has_key(key)
+
+	__contains__ = has_key
+
+	def get (self, key, default=None):
+		if self.dict.has_key(key):
+			return self.dict[key]
+		if self.parent is None:
+			return default
+		owner = self.parent.scope().get(key)
+		if owner is None:
+			return default
+		return owner[key]
 
 	def keys (self):
 		"""
-		Return the set of keys defined in this environment and its parents.
+		Return the list of keys defined in this environment and its parents.
 		"""
-		if self.parent is None:
-			return set(self.dict.keys())
-		else:
-			return set(self.parent.keys()) | set(self.dict.keys())
+		return self.scope().keys()
+
+	def __nonzero__ (self):
+		"""
+		An environment is always true, even if it is empty, so that it is not
+		mistaken for a missing dictionary (see 'parse_line'), and testing it
+		does not compute the set of its keys.
+		"""
+		return True
 
 	def new_key (self, key, value):
 		"""
@@ -294,6 +449,20 @@ class Variables (UserDict.DictMixin):
 		if self.dict.has_key(key):
 			raise KeyError
 		self.dict[key] = value
+		Variables.generation += 1
+
+	def snapshot (self):
+		"""
+		Return an environment without parent that holds the current values
+		of all the variables of this one, so that later changes do not
+		affect it. This copies every visible variable, so it takes time in
+		proportion to their number and is meant for occasional use, such as
+		keeping the context of a delayed module command.
+		"""
+		values = {}
+		for key, owner in self.scope().iteritems():
+			values[key] = owner[key]
+		return Variables(items=values)
 
 #-- Parsing commands --{{{1
 